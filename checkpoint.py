@@ -0,0 +1,313 @@
+'''Per-item checkpoints, so a retried item only fetches the IDs it lacks.
+
+Every wget-lua run of an item writes its WARC to a new segment in the
+``segments`` directory of the item. viddler.lua appends a line of
+``done <segment> <hex id>`` to ``checkpoint.log`` once all URLs of a video
+ID are fetched.
+
+A run that was killed can leave a segment that ends in the middle of a
+gzip member. Such a segment is cut back to its last whole member, and
+its last finished ID is taken back with an ``undone <segment> <hex id>``
+line, since its records may have been in the part that was cut off.
+wget's segments are only checked once, after which a ``salvaged
+<segment>`` line is added; until then their last finished ID does not
+count as done. The segments other writers append to are locked while
+they are checked.
+
+The gateway requests made for the item are appended to the ``amf``
+segment as they happen (see riddler.py), and the probe results of the
+item to the ``probe`` segment.
+
+Once the item is downloaded, its segments are joined into the ``merged``
+segment, each removed as soon as it is in, so the item takes little
+more space than its WARC. A reissued item adds its new segments to it.
+
+When the pipeline compresses the WARCs itself (see compression.py), wget
+writes the segment uncompressed as ``<segment>.warc`` first. A torn one
+is cut back to its last whole record in the same way.
+'''
+from __future__ import print_function
+
+import contextlib
+import errno
+import fcntl
+import os
+import shutil
+import zlib
+
+import warcwriter
+
+
+SEGMENT_DIR = 'segments'
+JOURNAL_NAME = 'checkpoint.log'
+AMF_SEGMENT = 'amf'
+PROBE_SEGMENT = 'probe'
+MERGED_SEGMENT = 'merged'
+
+
+class Checkpoint(object):
+    def __init__(self, item_dir):
+        self.item_dir = item_dir
+        self.segment_dir = os.path.join(item_dir, SEGMENT_DIR)
+        self.journal_path = os.path.join(item_dir, JOURNAL_NAME)
+
+    def exists(self):
+        return os.path.exists(self.journal_path) or \
+            os.path.isdir(self.segment_dir)
+
+    def segment_names(self):
+        if not os.path.isdir(self.segment_dir):
+            return []
+
+        names = set()
+
+        for filename in os.listdir(self.segment_dir):
+            for extension in ('.warc.gz', '.warc'):
+                if filename.endswith(extension):
+                    names.add(filename[:-len(extension)])
+
+        return sorted(names)
+
+    def segment_path(self, name):
+        return os.path.join(self.segment_dir, name + '.warc.gz')
+
+    def raw_segment_path(self, name):
+        '''The path of the segment while it is not compressed yet.'''
+        return os.path.join(self.segment_dir, name + '.warc')
+
+    def next_attempt(self):
+        attempts = [int(name.split('-')[0]) for name in self.segment_names()
+            if is_wget_segment(name)]
+        return max(attempts or [0]) + 1
+
+    def new_segment_name(self, attempt, suffix=''):
+        self.make_segment_dir()
+
+        return '%03d%s' % (attempt, suffix)
+
+    def make_segment_dir(self):
+        try:
+            os.makedirs(self.segment_dir)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+    @contextlib.contextmanager
+    def appending(self, name):
+        '''Open a segment for appending, locked against other writers.
+
+        Several threads and processes may append to the same segment.
+        '''
+        self.make_segment_dir()
+
+        with open(self.segment_path(name), 'ab') as out_file:
+            fcntl.flock(out_file, fcntl.LOCK_EX)
+
+            try:
+                yield out_file
+                out_file.flush()
+            finally:
+                fcntl.flock(out_file, fcntl.LOCK_UN)
+
+    def merge(self):
+        '''Join the other segments into the merged one and return its
+        path.'''
+        merged_path = self.segment_path(MERGED_SEGMENT)
+        names = [name for name in self.segment_names()
+            if name != MERGED_SEGMENT]
+
+        if len(names) == 1 and not os.path.exists(merged_path):
+            os.rename(self.segment_path(names[0]), merged_path)
+            return merged_path
+
+        # Gzipped WARCs can simply be concatenated.
+        for name in names:
+            with self.appending(MERGED_SEGMENT) as out_file:
+                with open(self.segment_path(name), 'rb') as in_file:
+                    shutil.copyfileobj(in_file, out_file)
+
+                out_file.flush()
+                os.fsync(out_file.fileno())
+
+            os.remove(self.segment_path(name))
+
+        return merged_path
+
+    def read_journal(self):
+        '''Return the finished IDs of each segment, in journal order.'''
+        segments = {}
+
+        if not os.path.exists(self.journal_path):
+            return segments
+
+        with open(self.journal_path) as in_file:
+            for line in in_file:
+                parts = line.split()
+
+                if len(parts) != 3:
+                    continue
+
+                action, segment, video_id = parts
+                video_ids = segments.setdefault(segment, [])
+
+                if action == 'done':
+                    video_ids.append(video_id)
+                elif action == 'undone' and video_id in video_ids:
+                    video_ids.remove(video_id)
+
+        return segments
+
+    def salvaged_segments(self):
+        '''Return the names of the wget segments that have been checked.'''
+        salvaged = set()
+
+        if not os.path.exists(self.journal_path):
+            return salvaged
+
+        with open(self.journal_path) as in_file:
+            for line in in_file:
+                parts = line.split()
+
+                if len(parts) == 2 and parts[0] == 'salvaged':
+                    salvaged.add(parts[1])
+
+        return salvaged
+
+    def salvage(self, wget_only=False):
+        '''Cut torn segments back to whole gzip members or records.
+
+        This reads every segment it checks in full, so keep it off the
+        event loop.
+        '''
+        journal = self.read_journal()
+        salvaged = self.salvaged_segments()
+
+        for name in self.segment_names():
+            is_wget = is_wget_segment(name)
+
+            if (is_wget and name in salvaged) or (wget_only and not is_wget):
+                continue
+
+            torn = False
+
+            for path, complete_length in (
+                    (self.segment_path(name), gzip_complete_length),
+                    (self.raw_segment_path(name),
+                        warcwriter.warc_complete_length)):
+                if os.path.exists(path):
+                    torn = cut_back(path, complete_length) or torn
+
+            if is_wget:
+                with open(self.journal_path, 'a') as out_file:
+                    out_file.write('salvaged %s\n' % name)
+
+            if not torn:
+                continue
+
+            # Its CDX can name records that were cut off
+            cdx_path = os.path.join(self.segment_dir, name + '.cdx')
+
+            if os.path.exists(cdx_path):
+                os.remove(cdx_path)
+
+            video_ids = journal.get(name)
+
+            if video_ids:
+                with open(self.journal_path, 'a') as out_file:
+                    out_file.write('undone %s %s\n' % (name, video_ids[-1]))
+
+    def done_ids(self):
+        '''Return the finished video IDs as integers.
+
+        The last ID of a wget segment that has not been salvaged yet is
+        left out, as its records may be torn.
+        '''
+        done = set()
+        salvaged = self.salvaged_segments()
+
+        for name, video_ids in self.read_journal().iteritems():
+            if is_wget_segment(name) and name not in salvaged:
+                video_ids = video_ids[:-1]
+
+            done.update(int(video_id, 16) for video_id in video_ids)
+
+        return done
+
+
+def is_wget_segment(name):
+    '''Whether wget-lua wrote the segment, rather than the pipeline.'''
+    return name[:1].isdigit()
+
+
+def cut_back(filename, complete_length):
+    '''Truncate the file to `complete_length(filename)` and return whether
+    it was longer. Appending writers are locked out meanwhile.'''
+    with open(filename, 'r+b') as segment_file:
+        fcntl.flock(segment_file, fcntl.LOCK_EX)
+
+        try:
+            length = complete_length(filename)
+
+            if length == os.path.getsize(filename):
+                return False
+
+            segment_file.truncate(length)
+            return True
+        finally:
+            fcntl.flock(segment_file, fcntl.LOCK_UN)
+
+
+def gzip_complete_length(filename, chunk_size=1048576):
+    '''Return the length of the file up to the end of its last whole
+    gzip member.'''
+    complete_length = 0
+    offset = 0
+    decompressor = None
+
+    with open(filename, 'rb') as in_file:
+        data = b''
+
+        while True:
+            if not data:
+                data = in_file.read(chunk_size)
+
+                if not data:
+                    break
+
+            if not decompressor:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            try:
+                decompressor.decompress(data)
+            except zlib.error:
+                break
+
+            if decompressor.unused_data:
+                # A member ended inside this chunk
+                used = len(data) - len(decompressor.unused_data)
+                offset += used
+                complete_length = offset
+                data = decompressor.unused_data
+                decompressor = None
+            else:
+                offset += len(data)
+                data = b''
+
+                if member_ended(decompressor):
+                    complete_length = offset
+                    decompressor = None
+
+    return complete_length
+
+
+def member_ended(decompressor):
+    # Python 2 has no decompressobj.eof, so feed a copy one more byte: it
+    # comes back as unused data only if the member is over.
+    probe = decompressor.copy()
+
+    try:
+        probe.decompress(b'\x1f')
+    except zlib.error:
+        return False
+
+    return bool(probe.unused_data)
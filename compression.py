@@ -0,0 +1,147 @@
+'''Compresses the uncompressed WARCs of wget in a pool of threads.
+
+wget-lua gzips every WARC record on its only thread while it downloads.
+With ``--no-warc-compression`` it writes the records as they are instead,
+and the CompressSegments task of the pipeline compresses them afterwards
+with this module. Each record becomes its own gzip member, just as wget
+would have written it, so the output is a normal ``.warc.gz``.
+
+zlib lets go of the interpreter lock while it compresses, so the threads
+run on as many cores as there are threads. The records are split into
+jobs of about `job_size` bytes. Each job is compressed into its own
+temporary file, and the files are joined in order.
+'''
+from __future__ import print_function
+
+import os
+import Queue
+import threading
+import zlib
+
+import warcwriter
+
+
+class CompressJob(object):
+    def __init__(self, spans):
+        self.spans = spans
+        self.part_path = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class WarcCompressor(object):
+    def __init__(self, level=6, threads=2, job_size=8 * 1024 * 1024,
+            chunk_size=1048576):
+        self.level = level
+        self.threads = threads
+        self.job_size = job_size
+        self.chunk_size = chunk_size
+
+    def compress(self, in_path, out_path):
+        '''Compress the whole records of `in_path` into `out_path` and
+        return the number of records and the lengths before and after.'''
+        with open(in_path, 'rb') as in_file:
+            jobs = list(self._make_jobs(warcwriter.record_spans(in_file)))
+
+        queue = Queue.Queue()
+        stopped = threading.Event()
+
+        for job in jobs:
+            queue.put(job)
+
+        threads = [threading.Thread(target=self._run,
+            args=(queue, stopped, in_path, out_path))
+            for dummy in range(min(self.threads, len(jobs)))]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        temp_path = out_path + '.tmp'
+
+        try:
+            with open(temp_path, 'wb') as out_file:
+                for job in jobs:
+                    job.done.wait()
+
+                    if job.error:
+                        raise job.error
+
+                    with open(job.part_path, 'rb') as part_file:
+                        while True:
+                            data = part_file.read(self.chunk_size)
+
+                            if not data:
+                                break
+
+                            out_file.write(data)
+
+                    os.remove(job.part_path)
+        finally:
+            # Jobs after a failed one are not needed
+            stopped.set()
+
+            for thread in threads:
+                thread.join()
+
+            for job in jobs:
+                if job.part_path and os.path.exists(job.part_path):
+                    os.remove(job.part_path)
+
+        os.rename(temp_path, out_path)
+
+        return (sum(len(job.spans) for job in jobs),
+            sum(length for job in jobs for offset, length in job.spans),
+            os.path.getsize(out_path))
+
+    def _make_jobs(self, spans):
+        job_spans = []
+        job_length = 0
+
+        for offset, length in spans:
+            job_spans.append((offset, length))
+            job_length += length
+
+            if job_length >= self.job_size:
+                yield CompressJob(job_spans)
+                job_spans = []
+                job_length = 0
+
+        if job_spans:
+            yield CompressJob(job_spans)
+
+    def _run(self, queue, stopped, in_path, out_path):
+        while not stopped.is_set():
+            try:
+                job = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            job.part_path = '{0}.{1}.part'.format(out_path,
+                job.spans[0][0])
+
+            try:
+                self._compress_job(job, in_path)
+            except Exception as error:
+                job.error = error
+            finally:
+                job.done.set()
+
+    def _compress_job(self, job, in_path):
+        with open(in_path, 'rb') as in_file:
+            with open(job.part_path, 'wb') as out_file:
+                for offset, length in job.spans:
+                    compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                        16 + zlib.MAX_WBITS)
+                    in_file.seek(offset)
+
+                    while length > 0:
+                        data = in_file.read(min(self.chunk_size, length))
+
+                        if not data:
+                            raise IOError('{0} ended early.'.format(in_path))
+
+                        out_file.write(compressor.compress(data))
+                        length -= len(data)
+
+                    out_file.write(compressor.flush())
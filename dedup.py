@@ -0,0 +1,145 @@
+'''An index of the page requisites that items have in common.
+
+Every video page pulls in the same CSS, JS and images of the site. wget
+writes a CDX line for each record (``--warc-cdx``) and, given an index
+of earlier records (``--warc-dedup``), writes a revisit record for a
+payload it has seen before under the same URL instead of the payload.
+
+The index is a CDX file holding only the fields wget looks at: the URL,
+the payload digest and the ID of the record with the payload. It keeps
+the entries seen most recently across items, up to `max_entries`.
+Several processes can save to the same file; see DedupIndex.save.
+'''
+from __future__ import print_function
+
+import collections
+import fcntl
+import os
+import re
+import tempfile
+import threading
+
+
+CDX_HEADER = ' CDX a k u\n'
+
+# Pages and videos that belong to one video ID only are not worth keeping
+UNIQUE_URL_PATTERN = re.compile(
+    r'viddler\.com/(v|embed|file)/|amfgateway|\.(flv|mp4)(\?|$)')
+
+
+class DedupIndex(object):
+    def __init__(self, max_entries=50000):
+        self.max_entries = max_entries
+        self.filename = None
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, filename):
+        with self._lock:
+            if filename != self.filename:
+                self.filename = filename
+                self._entries = collections.OrderedDict(
+                    ((url, digest), record_id)
+                    for url, digest, record_id in read_cdx(filename, 'aku'))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add_cdx(self, cdx_filename):
+        '''Take in the records of a CDX file written by wget and return the
+        number of new entries.'''
+        new_count = 0
+
+        with self._lock:
+            for url, mime, status, digest, record_id in read_cdx(
+                    cdx_filename, 'amsku'):
+                if status != '200' or UNIQUE_URL_PATTERN.search(url):
+                    continue
+
+                key = (url, digest)
+
+                if key in self._entries:
+                    # Seen again: keep the original record, move it up
+                    self._entries[key] = self._entries.pop(key)
+                elif mime != 'warc/revisit':
+                    self._entries[key] = record_id
+                    new_count += 1
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return new_count
+
+    def save(self):
+        '''Write the index; wget only ever sees a complete file.
+
+        Other processes may share the file. While holding a lock on it,
+        the entries they have saved are merged in before it is replaced.
+        '''
+        with self._lock:
+            fd = os.open(self.filename + '.lock', os.O_RDWR | os.O_CREAT,
+                0o644)
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self._merge_saved()
+                self._write()
+            finally:
+                os.close(fd)
+
+    def _merge_saved(self):
+        '''Add the entries of the file we do not have, as the oldest.'''
+        entries = collections.OrderedDict()
+
+        for url, digest, record_id in read_cdx(self.filename, 'aku'):
+            if (url, digest) not in self._entries:
+                entries[(url, digest)] = record_id
+
+        entries.update(self._entries)
+
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+        self._entries = entries
+
+    def _write(self):
+        dirname, basename = os.path.split(self.filename)
+        handle, temp_filename = tempfile.mkstemp(prefix=basename + '.',
+            suffix='.tmp', dir=dirname or '.')
+
+        try:
+            with os.fdopen(handle, 'w') as out_file:
+                out_file.write(CDX_HEADER)
+
+                for (url, digest), record_id in self._entries.iteritems():
+                    out_file.write('%s %s %s\n' % (url, digest, record_id))
+
+            os.chmod(temp_filename, 0o644)
+            os.rename(temp_filename, self.filename)
+        except Exception:
+            os.remove(temp_filename)
+            raise
+
+
+def read_cdx(filename, fields):
+    '''Yield a tuple of the named fields for each line of a CDX file.'''
+    if not os.path.exists(filename):
+        return
+
+    with open(filename) as in_file:
+        header = in_file.readline().split()
+
+        if not header or header[0] != 'CDX':
+            return
+
+        # The first column of that letter, since wget writes 'a' twice
+        names = header[1:]
+        positions = [names.index(field) for field in fields]
+
+        for line in in_file:
+            values = line.split()
+
+            if len(values) != len(names):
+                continue
+
+            yield tuple(values[position] for position in positions)
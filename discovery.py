@@ -0,0 +1,96 @@
+'''Remembers slow startup checks between runs.
+
+Finding Wget+Lua runs every candidate with a version flag. The result
+only changes when the file does, so it is kept in a JSON file under the
+path of the file and valid for as long as its modification time and
+size stay the same.
+
+The hashes of the pipeline's own files, which tell the tracker what code
+ran, are not kept here: a file can change without a new modification
+time or size, and hashing them is quick.
+'''
+from __future__ import print_function
+
+import json
+import os
+
+
+class DiscoveryCache(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self._entries = {}
+        self._dirty = False
+
+        try:
+            with open(filename) as in_file:
+                self._entries = json.load(in_file)
+        except (IOError, ValueError):
+            pass
+
+    def get(self, kind, path):
+        '''Return the cached value or None if the file has changed.'''
+        stat = file_stat(path)
+        entry = self._entries.get(path)
+
+        if stat and entry and entry['stat'] == stat:
+            return entry['values'].get(kind)
+
+    def put(self, kind, path, value):
+        stat = file_stat(path)
+
+        if not stat:
+            return
+
+        entry = self._entries.get(path)
+
+        if not entry or entry['stat'] != stat:
+            entry = self._entries[path] = {'stat': stat, 'values': {}}
+
+        entry['values'][kind] = value
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        temp_filename = self.filename + '.tmp'
+
+        try:
+            with open(temp_filename, 'w') as out_file:
+                json.dump(self._entries, out_file, indent=2, sort_keys=True)
+
+            os.rename(temp_filename, self.filename)
+        except (IOError, OSError):
+            # Only a missed shortcut on the next start
+            return
+
+        self._dirty = False
+
+    def find_executable(self, name, version, paths, test_executable,
+            version_arg='-V'):
+        '''Like seesaw.util.find_executable, but runs `test_executable`
+        only for files it has not seen before.'''
+        kind = 'executable:{0}:{1}'.format(json.dumps(version), version_arg)
+
+        for path in paths:
+            if not file_stat(path):
+                continue
+
+            usable = self.get(kind, path)
+
+            if usable is None:
+                usable = bool(test_executable(name, version, path,
+                    version_arg))
+                self.put(kind, path, usable)
+
+            if usable:
+                return path
+
+
+def file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return [stat.st_mtime, stat.st_size]
@@ -0,0 +1,156 @@
+'''Timing events and their summaries.
+
+Events are JSON objects, one per line, with an ``event`` kind:
+
+* ``stage``: a pipeline task finished for an item (``stage``, ``seconds``)
+* ``url``: wget-lua or the video fetcher fetched a URL (``url``,
+  ``status``, ``bytes``, ``seconds``)
+* ``resolve``: the resolver pool answered for a video (``video_id``,
+  ``urls``, ``seconds``)
+'''
+from __future__ import print_function
+
+import BaseHTTPServer
+import collections
+import json
+import threading
+
+
+def append_event(filename, event):
+    line = json.dumps(event, sort_keys=True) + '\n'
+
+    # One write per line keeps lines whole when several processes append
+    with open(filename, 'ab') as out_file:
+        out_file.write(line)
+
+
+def read_events(filename):
+    with open(filename, 'rb') as in_file:
+        for line in in_file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Torn line from a killed process
+                continue
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def summarize(values):
+    '''Return count, total and percentiles of a list of numbers.'''
+    if not values:
+        return {'count': 0}
+
+    values = sorted(values)
+
+    return {
+        'count': len(values),
+        'total': sum(values),
+        'p50': percentile(values, 0.5),
+        'p90': percentile(values, 0.9),
+        'p99': percentile(values, 0.99),
+        'max': values[-1],
+    }
+
+
+def summarize_events(events):
+    '''Summarize the url and resolve events of an item.'''
+    url_seconds = []
+    url_bytes = 0
+    statuses = collections.defaultdict(int)
+    resolve_seconds = []
+
+    for event in events:
+        kind = event.get('event')
+
+        if kind == 'url':
+            url_seconds.append(event['seconds'])
+            url_bytes += event.get('bytes') or 0
+            statuses[str(event.get('status'))] += 1
+        elif kind == 'resolve':
+            resolve_seconds.append(event['seconds'])
+
+    return {
+        'url_seconds': summarize(url_seconds),
+        'url_bytes': url_bytes,
+        'url_statuses': dict(statuses),
+        'resolve_seconds': summarize(resolve_seconds),
+    }
+
+
+class Metrics(object):
+    '''Recent timings of all items, for the metrics endpoint.'''
+    def __init__(self, history=1000):
+        self._values = collections.defaultdict(
+            lambda: collections.deque(maxlen=history))
+        self._counters = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, name, value):
+        with self._lock:
+            self._values[name].append(value)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'timings': dict((name, summarize(list(values)))
+                    for name, values in self._values.iteritems()),
+            }
+
+
+def combine(metrics_dicts):
+    '''Add up the ``Metrics.to_dict()`` of several processes.
+
+    Percentiles cannot be added up, so the highest of each is kept.
+    '''
+    counters = collections.defaultdict(int)
+    timings = {}
+
+    for metrics_dict in metrics_dicts:
+        for name, value in metrics_dict.get('counters', {}).iteritems():
+            counters[name] += value
+
+        for name, summary in metrics_dict.get('timings', {}).iteritems():
+            combined = timings.setdefault(name, {'count': 0})
+
+            for key, value in summary.iteritems():
+                if key in ('count', 'total'):
+                    combined[key] = combined.get(key, 0) + value
+                else:
+                    combined[key] = max(combined.get(key, value), value)
+
+    return {
+        'processes': len(metrics_dicts),
+        'counters': dict(counters),
+        'timings': timings,
+    }
+
+
+def serve_metrics(metrics, port, address='127.0.0.1'):
+    '''Serve ``metrics.to_dict()`` as JSON over HTTP in a thread.'''
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(metrics.to_dict(), indent=2, sort_keys=True)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((address, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
@@ -0,0 +1,152 @@
+'''What earlier items found out about each video ID.
+
+The index lives in a directory next to the item directories, and is
+kept open for as long as the pipeline runs:
+
+* ``dead/`` and ``archived/`` are bitmaps over the ID space, of the IDs
+  that answered 404 and of the live IDs that finished items have saved.
+  They are split into chunk files of 65536 IDs (8 KiB), which are read
+  only when an item needs them, so memory stays small even when the
+  bitmaps cover all 32-bit IDs.
+* ``live.db`` is a dbm file with an entry for every archived ID: the
+  item, the status, the resolved video URLs and the bytes fetched.
+'''
+from __future__ import print_function
+
+import anydbm
+import collections
+import json
+import os
+import threading
+
+
+CHUNK_SHIFT = 16
+CHUNK_BYTES = (1 << CHUNK_SHIFT) // 8
+
+
+class Bitmap(object):
+    def __init__(self, dirname, max_chunks=64):
+        self.dirname = dirname
+        self.max_chunks = max_chunks
+        self._chunks = collections.OrderedDict()
+        self._dirty = set()
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def __contains__(self, number):
+        chunk = self._get_chunk(number >> CHUNK_SHIFT)
+        offset = number & ((1 << CHUNK_SHIFT) - 1)
+
+        return bool(chunk[offset >> 3] & (1 << (offset & 7)))
+
+    def add(self, number):
+        chunk_index = number >> CHUNK_SHIFT
+        chunk = self._get_chunk(chunk_index)
+        offset = number & ((1 << CHUNK_SHIFT) - 1)
+
+        chunk[offset >> 3] |= 1 << (offset & 7)
+        self._dirty.add(chunk_index)
+
+    def save(self):
+        for chunk_index in list(self._dirty):
+            self._save_chunk(chunk_index)
+
+    def _chunk_path(self, chunk_index):
+        return os.path.join(self.dirname, '{0:x}.bits'.format(chunk_index))
+
+    def _get_chunk(self, chunk_index):
+        chunk = self._chunks.pop(chunk_index, None)
+
+        if chunk is None:
+            path = self._chunk_path(chunk_index)
+
+            if os.path.exists(path):
+                with open(path, 'rb') as in_file:
+                    chunk = bytearray(in_file.read())
+            else:
+                chunk = bytearray(CHUNK_BYTES)
+
+        self._chunks[chunk_index] = chunk
+
+        while len(self._chunks) > self.max_chunks:
+            old_index = next(iter(self._chunks))
+
+            if old_index in self._dirty:
+                self._save_chunk(old_index)
+
+            del self._chunks[old_index]
+
+        return chunk
+
+    def _save_chunk(self, chunk_index):
+        path = self._chunk_path(chunk_index)
+
+        with open(path + '.tmp', 'wb') as out_file:
+            out_file.write(self._chunks[chunk_index])
+
+        os.rename(path + '.tmp', path)
+        self._dirty.discard(chunk_index)
+
+
+class OutcomeIndex(object):
+    def __init__(self):
+        self.dirname = None
+        self._lock = threading.Lock()
+
+    def open(self, dirname):
+        with self._lock:
+            if dirname == self.dirname:
+                return
+
+            self._close()
+            self.dirname = dirname
+            self.dead = Bitmap(os.path.join(dirname, 'dead'))
+            self.archived = Bitmap(os.path.join(dirname, 'archived'))
+            self._live = anydbm.open(os.path.join(dirname, 'live.db'), 'c')
+
+    def is_dead(self, video_id):
+        with self._lock:
+            return video_id in self.dead
+
+    def is_archived(self, video_id):
+        with self._lock:
+            return video_id in self.archived
+
+    def get(self, video_id):
+        '''Return the entry of an archived ID or None.'''
+        with self._lock:
+            value = self._live.get('{0:x}'.format(video_id))
+
+        if value:
+            return json.loads(value)
+
+    def add_dead(self, video_ids):
+        with self._lock:
+            for video_id in video_ids:
+                self.dead.add(video_id)
+
+    def add_archived(self, video_id, entry):
+        with self._lock:
+            self.archived.add(video_id)
+            self._live['{0:x}'.format(video_id)] = json.dumps(entry,
+                sort_keys=True, separators=(',', ':'))
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self.dirname:
+            self.dead.save()
+            self.archived.save()
+            self._live.close()
+            self.dirname = None
+
+    def save(self):
+        with self._lock:
+            self.dead.save()
+            self.archived.save()
+
+            if hasattr(self._live, 'sync'):
+                self._live.sync()
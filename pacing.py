@@ -0,0 +1,139 @@
+'''Adaptive request pacing per host.
+
+wget-lua reports the results of the requests it used to sleep after to
+the pipeline (see resolver.py), and the answer is held back until the
+next request to that host may go out. Each host has a request rate that
+grows slowly while the host answers well and halves on 429, 5xx,
+connection errors and slow answers. Requests are spaced by a token
+bucket at that rate. Every item has buckets of its own, like the fixed
+sleep it replaces, so running more items at once still adds up.
+
+A :class:`SharedByteRate` can add a bandwidth budget on top, which is
+kept in a small file so that several pipeline processes can share it.
+'''
+from __future__ import print_function
+
+import fcntl
+import os
+import struct
+import threading
+import time
+
+
+class HostPacer(object):
+    def __init__(self, initial_rate=10, min_rate=0.2, max_rate=50,
+            increase=0.5, burst=2, slow_seconds=10, fast_hosts=('cdn',),
+            byte_rate=None):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.burst = burst
+        self.slow_seconds = slow_seconds
+        self.fast_hosts = fast_hosts
+        self.byte_rate = byte_rate
+        self._rates = {}
+        self._next_times = {}
+        self._lock = threading.Lock()
+
+    def pace(self, host, status, seconds, byte_count=0, item=None):
+        '''Take in a result and return how long to wait before the next
+        request of the item to the host.'''
+        with self._lock:
+            self._observe((item, host), status, seconds)
+            delay = self._reserve((item, host))
+
+        if self.byte_rate:
+            delay = max(delay, self.byte_rate.consume(byte_count))
+
+        return delay
+
+    def rate(self, host, item=None):
+        with self._lock:
+            return self._get_rate((item, host))
+
+    def forget(self, item):
+        '''Drop the buckets of an item that is done.'''
+        with self._lock:
+            for key in [key for key in self._rates if key[0] == item]:
+                del self._rates[key]
+                self._next_times.pop(key, None)
+
+    def _get_rate(self, key):
+        if key not in self._rates:
+            # Media hosts can take what a browser would throw at them
+            if any(name in key[1] for name in self.fast_hosts):
+                self._rates[key] = self.max_rate
+            else:
+                self._rates[key] = self.initial_rate
+
+        return self._rates[key]
+
+    def _observe(self, key, status, seconds):
+        rate = self._get_rate(key)
+
+        if status == 429 or status >= 500 or not status or \
+                seconds > self.slow_seconds:
+            rate = max(self.min_rate, rate / 2.0)
+
+            # Give the host a rest before the next request
+            self._next_times[key] = max(self._next_times.get(key, 0),
+                time.time() + 1.0 / rate)
+        else:
+            rate = min(self.max_rate, rate + self.increase)
+
+        self._rates[key] = rate
+
+    def _reserve(self, key):
+        now = time.time()
+        interval = 1.0 / self._rates[key]
+
+        # Unused time allows a burst of up to `burst` requests
+        next_time = max(self._next_times.get(key, 0),
+            now - (self.burst - 1) * interval)
+        self._next_times[key] = next_time + interval
+
+        return max(0, next_time - now)
+
+
+class SharedByteRate(object):
+    '''A limit of `rate` bytes per second for all processes that use the
+    same file.
+
+    The file holds the time until which the bytes transferred so far are
+    paid for. Up to `burst` seconds of unused budget can be spent at once.
+    '''
+    RECORD = struct.Struct('<d')
+
+    def __init__(self, filename, rate, burst=1.0):
+        self.filename = filename
+        self.rate = float(rate)
+        self.burst = burst
+
+    def consume(self, byte_count):
+        '''Account for `byte_count` bytes and return how long to wait
+        before transferring more.'''
+        if byte_count <= 0:
+            return 0
+
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.read(fd, self.RECORD.size)
+            now = time.time()
+
+            if len(data) == self.RECORD.size:
+                paid_until = self.RECORD.unpack(data)[0]
+            else:
+                paid_until = now - self.burst
+
+            paid_until = max(paid_until, now - self.burst) + \
+                byte_count / self.rate
+
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, self.RECORD.pack(paid_until))
+        finally:
+            os.close(fd)
+
+        return max(0, paid_until - now)
@@ -1,8 +1,12 @@
+import collections
 import datetime
 from distutils.version import StrictVersion
+import errno
 import glob
 import hashlib
+import imp
 import json
+import mmap
 import os
 import re
 import seesaw
@@ -11,14 +15,18 @@ from seesaw.externalprocess import WgetDownload, RsyncUpload, CurlUpload
 from seesaw.item import ItemInterpolation, ItemValue
 from seesaw.pipeline import Pipeline
 from seesaw.project import Project
-from seesaw.task import SimpleTask, LimitConcurrent
+from seesaw.task import Task, SimpleTask
 from seesaw.tracker import (GetItemFromTracker, SendDoneToTracker,
     PrepareStatsForTracker, UploadWithTracker)
-from seesaw.util import find_executable
+from seesaw.util import test_executable
 import shutil
 import socket
 import sys
+import tempfile
+import threading
 import time
+from tornado import ioloop
+import traceback
 
 
 # check the seesaw version
@@ -26,13 +34,69 @@ if StrictVersion(seesaw.__version__) < StrictVersion("0.1.5"):
     raise Exception("This pipeline needs seesaw version 0.1.5 or higher.")
 
 
+# Helper modules live next to this file.
+sys.path.insert(0, os.getcwd())
+import checkpoint
+import compression
+import dedup
+import discovery
+import metrics
+import outcomes
+import pacing
+import probe
+import resolver
+import videos
+import warcwriter
+
+
+# Results of the slow startup checks, kept between runs
+DISCOVERY_CACHE = discovery.DiscoveryCache(
+    os.path.join(os.getcwd(), ".discovery-cache.json"))
+
+# Seesaw removes item["data_dir"] when the item is done, so what is kept
+# across items goes here.
+DATA_DIR = os.path.join(os.getcwd(), "data")
+CHECKPOINT_DIR = os.path.join(DATA_DIR, "checkpoints")
+
+# Items not worked on for this long have gone to someone else by now
+CHECKPOINT_MAX_AGE = 3 * 24 * 3600
+
+
+def prune_checkpoints(max_age):
+    '''Remove the directories of failed or abandoned items that nothing
+    has been written to for `max_age` seconds.'''
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return
+
+    now = time.time()
+
+    for name in os.listdir(CHECKPOINT_DIR):
+        dirname = os.path.join(CHECKPOINT_DIR, name)
+
+        try:
+            modified = max(os.path.getmtime(os.path.join(path, filename))
+                for path, dirnames, filenames in os.walk(dirname)
+                for filename in dirnames + filenames + ["."])
+        except (OSError, ValueError):
+            # Removed by another worker meanwhile
+            continue
+
+        if now - modified > max_age:
+            shutil.rmtree(dirname, ignore_errors=True)
+
+
+prune_checkpoints(CHECKPOINT_MAX_AGE)
+
+
 ###########################################################################
 # Find a useful Wget+Lua executable.
 #
 # WGET_LUA will be set to the first path that
 # 1. does not crash with --version, and
 # 2. prints the required version string
-WGET_LUA = find_executable(
+#
+# Paths that were checked before and have not changed since are not run.
+WGET_LUA = DISCOVERY_CACHE.find_executable(
     "Wget+Lua",
     ["GNU Wget 1.14.lua.20130523-9a5c"],
     [
@@ -43,16 +107,20 @@ WGET_LUA = find_executable(
         "../../wget-lua",
         "/home/warrior/wget-lua",
         "/usr/bin/wget-lua"
-    ]
+    ],
+    test_executable
 )
 
+DISCOVERY_CACHE.save()
+
 if not WGET_LUA:
     raise Exception("No usable Wget+Lua found.")
 
 
 def check_imports():
-    import pyamf.remoting
-    from Crypto.Cipher import Blowfish
+    # Only find them; riddler.py imports them when they are first needed.
+    for name in ("pyamf", "Crypto"):
+        imp.find_module(name)
 
 
 check_imports()
@@ -68,6 +136,12 @@ USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, lik
 TRACKER_ID = 'viddler'
 TRACKER_HOST = 'tracker.archiveteam.org'
 
+# Workers of supervisor.py reach the tracker through the supervisor
+if 'tracker_proxy' in globals():
+    TRACKER_URL = "http://%s/%s" % (globals()['tracker_proxy'], TRACKER_ID)
+else:
+    TRACKER_URL = "http://%s/%s" % (TRACKER_HOST, TRACKER_ID)
+
 
 ###########################################################################
 # This section defines project-specific tasks.
@@ -75,52 +149,549 @@ TRACKER_HOST = 'tracker.archiveteam.org'
 # Simple tasks (tasks that do not need any concurrency) are based on the
 # SimpleTask class and have a process(item) method that is called for
 # each item.
-class CheckIP(SimpleTask):
-    def __init__(self, warc_prefix):
-        SimpleTask.__init__(self, "CheckIP")
-        self._counter = 0
+class ThreadedTask(Task):
+    '''Like SimpleTask, but process(item) runs in a separate thread.
+
+    Use it for work that would otherwise block the event loop. The item
+    is not thread-safe, so process(item) logs with log() and returns the
+    properties to set on the item (if any) as a dict; both are passed on
+    to the event loop.
+    '''
+    def enqueue(self, item):
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+
+        thread = threading.Thread(target=self._run, args=(item,))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, item):
+        try:
+            properties = self.process(item)
+        except Exception as e:
+            ioloop.IOLoop.instance().add_callback(self._fail, item, e,
+                traceback.format_exc())
+        else:
+            ioloop.IOLoop.instance().add_callback(self._complete, item,
+                properties)
+
+    def log(self, item, message):
+        ioloop.IOLoop.instance().add_callback(item.log_output, message)
+
+    def _fail(self, item, e, formatted_traceback):
+        item.log_output("Failed %s for %s\n" % (self, item.description()))
+        item.log_output("%s\n" % formatted_traceback)
+        item.log_error(self, e)
+        self.fail_item(item)
+
+    def _complete(self, item, properties=None):
+        for key, value in (properties or {}).iteritems():
+            item[key] = value
+
+        item.log_output("Finished %s for %s\n" % (self, item.description()))
+        self.complete_item(item)
+
+
+class StageTimer(object):
+    '''Records how long each task of the pipeline takes for each item.
+
+    The durations go to item["stage_seconds"], to `metrics` and, as stage
+    events, to timings.jsonl in the data directory.
+    '''
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._start_times = {}
+
+    def attach(self, tasks):
+        for task in tasks:
+            self._wrap(task)
+
+    def _wrap(self, task):
+        start_item = task.start_item
+        complete_item = task.complete_item
+        fail_item = task.fail_item
+
+        def timed_start_item(item):
+            self._start_times[(item.item_id, task.name)] = time.time()
+            start_item(item)
+
+        def timed_complete_item(item):
+            self._finish(task, item, "completed")
+            complete_item(item)
+
+        def timed_fail_item(item):
+            self._finish(task, item, "failed")
+            fail_item(item)
+
+        task.start_item = timed_start_item
+        task.complete_item = timed_complete_item
+        task.fail_item = timed_fail_item
+
+    def _finish(self, task, item, status):
+        start_time = self._start_times.pop((item.item_id, task.name), None)
+
+        if start_time is None:
+            return
+
+        seconds = time.time() - start_time
+        self.metrics.add("stage." + task.name, seconds)
+
+        if "stage_seconds" not in item:
+            item["stage_seconds"] = {}
+
+        item["stage_seconds"][task.name] = seconds
+
+        if "data_dir" in item:
+            metrics.append_event("%(data_dir)s/timings.jsonl" % item, {
+                "event": "stage",
+                "item": item["item_name"] if "item_name" in item else None,
+                "stage": task.name,
+                "status": status,
+                "seconds": seconds,
+            })
+
+
+class CheckIP(Task):
+    '''Makes sure www.viddler.com resolves to Viddler's own addresses.
+
+    The lookup runs in a thread; items that arrive meanwhile wait for its
+    answer. A good answer is trusted for `ttl` seconds, while a bad one
+    fails the items and is looked up again for the next item.
+    `resolve(host)` returns all addresses of the host and can be replaced
+    with a stub.
+    '''
+    def __init__(self, host="www.viddler.com",
+            allowed=("75.98.67.106", "75.98.67.105"), ttl=600,
+            resolve=None):
+        Task.__init__(self, "CheckIP")
+        self.host = host
+        self.allowed = allowed
+        self.ttl = ttl
+        self.resolve = resolve or resolve_addresses
+        self._checked_until = 0
+        self._waiting_items = None
+
+    def enqueue(self, item):
+        self.start_item(item)
+
+        if time.time() < self._checked_until:
+            self.complete_item(item)
+            return
+
+        if self._waiting_items is not None:
+            self._waiting_items.append(item)
+            return
+
+        self._waiting_items = [item]
 
-    def process(self, item):
+        thread = threading.Thread(target=self._lookup)
+        thread.daemon = True
+        thread.start()
+
+    def _lookup(self):
         # NEW for 2014! Check if we are behind firewall/proxy
-        ip_str = socket.gethostbyname('www.viddler.com')
-        if ip_str not in ('75.98.67.106', '75.98.67.105'):
-            item.log_output('Got IP address: %s' % ip_str)
-            item.log_output(
-                'Are you behind a firewall/proxy? That is a big no-no!')
-            raise Exception(
-                'Are you behind a firewall/proxy? That is a big no-no!')
+        try:
+            addresses = self.resolve(self.host)
+        except Exception as e:
+            ioloop.IOLoop.instance().add_callback(self._finish, None, e,
+                traceback.format_exc())
+        else:
+            ioloop.IOLoop.instance().add_callback(self._finish, addresses)
+
+    def _finish(self, addresses, e=None, formatted_traceback=None):
+        items, self._waiting_items = self._waiting_items, None
+
+        if not e and addresses and \
+                all(address in self.allowed for address in addresses):
+            self._checked_until = time.time() + self.ttl
+
+            for item in items:
+                self.complete_item(item)
+
+            return
 
-        # Check only occasionally
-        if self._counter <= 0:
-            self._counter = 10
+        self._checked_until = 0
+
+        if e:
+            messages = ["%s\n" % formatted_traceback]
         else:
-            self._counter -= 1
+            messages = [
+                'Got IP addresses: %s\n' % ', '.join(addresses),
+                'Are you behind a firewall/proxy? That is a big no-no!\n',
+            ]
+            e = Exception(
+                'Are you behind a firewall/proxy? That is a big no-no!')
+
+        for item in items:
+            for message in messages:
+                item.log_output(message)
+
+            item.log_error(self, e)
+            self.fail_item(item)
+
+
+def resolve_addresses(host):
+    '''Return all IPv4 addresses of the host.'''
+    return socket.gethostbyname_ex(host)[2]
 
 
 class PrepareDirectories(SimpleTask):
-    def __init__(self, warc_prefix):
+    def __init__(self, warc_prefix, shard_count=1):
         SimpleTask.__init__(self, "PrepareDirectories")
         self.warc_prefix = warc_prefix
+        self.shard_count = shard_count
 
     def process(self, item):
         item_name = item["item_name"]
-        dirname = "/".join((item["data_dir"], item_name))
+        dirname = os.path.join(CHECKPOINT_DIR, item_name)
 
-        if os.path.isdir(dirname):
+        # Keep what an earlier run of the item has finished.
+        if os.path.isdir(dirname) and \
+                not checkpoint.Checkpoint(dirname).exists():
             shutil.rmtree(dirname)
 
-        os.makedirs(dirname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
 
         item["item_dir"] = dirname
         item["warc_file_base"] = "%s-%s-%s" % (self.warc_prefix, item_name,
             time.strftime("%Y%m%d-%H%M%S"))
 
-        open("%(item_dir)s/%(warc_file_base)s.warc.gz" % item, "w").close()
+        start, end = item_name.split(':', 1)
+        shard_count = int(realize(self.shard_count, item))
+        shard_ranges = list(split_range(int(start), int(end), shard_count))
+        shards = []
+
+        for index, (shard_start, shard_end) in enumerate(shard_ranges):
+            if len(shard_ranges) == 1:
+                suffix = ""
+            else:
+                suffix = "-%02d" % index
+
+            shards.append({
+                "start": shard_start,
+                "end": shard_end,
+                "suffix": suffix,
+            })
+
+        item["shards"] = shards
+
+
+def split_range(start, end, count):
+    '''Split the inclusive range into at most `count` contiguous ranges.'''
+    size = end - start + 1
+    count = max(1, min(count, size))
+
+    for index in range(count):
+        yield (start + size * index // count,
+            start + size * (index + 1) // count - 1)
+
+
+def write_url_file(filename, video_ids):
+    '''Write the video page URLs for wget's --input-file and return how
+    many there are.
+
+    `video_ids` can be any iterable, so no list of the URLs is needed.
+    '''
+    count = 0
+
+    with open(filename, "w") as out_file:
+        for video_id in video_ids:
+            # Note: it appears viddler doesn't use leading 0 padding so
+            # don't include it
+            out_file.write(probe.video_url(video_id) + "\n")
+            count += 1
+
+    return count
+
+
+def read_url_file(filename):
+    '''Yield the video IDs of a file written by write_url_file.'''
+    with open(filename) as in_file:
+        for line in in_file:
+            yield int(line.rstrip().rsplit("/", 1)[1], 16)
+
+
+class ProbeIDs(ThreadedTask):
+    '''Finds the live IDs of the item with HEAD requests.
+
+    IDs that `outcome_index` knows are dead or archived are not asked
+    about again, and archived IDs are left out of wget's list.
+    '''
+    def __init__(self, concurrency, outcome_index=None):
+        ThreadedTask.__init__(self, "ProbeIDs")
+        self.concurrency = concurrency
+        self.outcome_index = outcome_index
+
+    def process(self, item):
+        if self.outcome_index:
+            self.outcome_index.open(OUTCOME_INDEX_DIRNAME)
+
+        probe_filenames = glob.glob("%(item_dir)s/*.probe.txt.gz" % item)
+
+        if probe_filenames:
+            # A resumed item was probed by its earlier run.
+            results = probe.read_results(probe_filenames[0])
+        else:
+            results = self.probe(item)
+
+        shards = []
+
+        for shard in item["shards"]:
+            live_ids = (video_id
+                for video_id in xrange(shard["start"], shard["end"] + 1)
+                if probe.is_live(results.get(video_id)) and
+                    not self.is_archived(video_id))
+
+            input_filename = "%s/urls%s.txt" % (item["item_dir"],
+                shard["suffix"])
+
+            shards.append(dict(shard, input_file=input_filename,
+                live_count=write_url_file(input_filename, live_ids)))
+
+        self.log(item, "%d of %d IDs are live.\n" % (
+            sum(shard["live_count"] for shard in shards), len(results)))
+
+        return {"shards": shards}
+
+    def probe(self, item):
+        prober = probe.Prober(concurrency=int(realize(self.concurrency, item)))
+        results = {}
+
+        for shard in item["shards"]:
+            unknown_ids = []
+
+            for video_id in xrange(shard["start"], shard["end"] + 1):
+                status = self.known_status(video_id)
+
+                if status is None:
+                    unknown_ids.append(video_id)
+                else:
+                    results[video_id] = status
+
+            results.update(prober.probe(unknown_ids))
+
+        # Keep a record of the misses in the WARC since wget will not see
+        # them. The results file tells a resumed item that it is written.
+        item_checkpoint = checkpoint.Checkpoint(item["item_dir"])
 
+        with item_checkpoint.appending(checkpoint.PROBE_SEGMENT) as out_file:
+            warcwriter.WarcWriter(out_file).write_record('resource',
+                probe.format_results(results), 'text/plain',
+                "metadata://viddler-grab/probe/%(item_name)s" % item)
 
-class MoveFiles(SimpleTask):
+        probe.write_results(
+            "%(item_dir)s/%(warc_file_base)s.probe.txt.gz" % item, results)
+
+        return results
+
+    def known_status(self, video_id):
+        if not self.outcome_index:
+            return None
+
+        if self.outcome_index.is_dead(video_id):
+            return probe.MISS_STATUS
+
+        entry = self.outcome_index.get(video_id)
+
+        if entry:
+            return entry["status"]
+
+    def is_archived(self, video_id):
+        return self.outcome_index and \
+            self.outcome_index.is_archived(video_id)
+
+
+RESOLVER_POOL = resolver.ResolverPool(size=2)
+RESOLVER_CHANNELS = {}
+VIDEO_FETCHERS = {}
+OUTCOME_INDEX = outcomes.OutcomeIndex()
+OUTCOME_INDEX_DIRNAME = os.path.join(DATA_DIR, "outcomes")
+
+# The dbm file of the index can only be open in one process
+if 'worker_id' in globals():
+    OUTCOME_INDEX_DIRNAME += "-" + globals()['worker_id']
+
+# A bandwidth budget in KiB/s, shared by all processes using the file
+if 'bandwidth_limit' in globals():
+    BYTE_RATE = pacing.SharedByteRate(
+        globals().get('bandwidth_file',
+            os.path.join(os.getcwd(), ".bandwidth")),
+        int(globals()['bandwidth_limit']) * 1024)
+else:
+    BYTE_RATE = None
+
+HOST_PACER = pacing.HostPacer(byte_rate=BYTE_RATE)
+DEDUP_INDEX = dedup.DedupIndex()
+DEDUP_INDEX_FILENAME = os.path.join(DATA_DIR, "dedup.cdx")
+
+
+class SalvageSegments(ThreadedTask):
+    '''Cuts torn WARC segments back to whole records; see checkpoint.py.
+
+    Before StartResolver it checks what earlier runs of the item left.
+    After WgetDownload, with `wget_only`, it checks the segments of
+    wget's retries, while the other segments may still be written to.
+    '''
+    def __init__(self, name="SalvageSegments", wget_only=False):
+        ThreadedTask.__init__(self, name)
+        self.wget_only = wget_only
+
+    def process(self, item):
+        checkpoint.Checkpoint(item["item_dir"]).salvage(
+            wget_only=self.wget_only)
+
+
+class StartResolver(SimpleTask):
+    '''Opens the resolver pipes for wget-lua, and starts fetching the
+    videos of the item as they are resolved if `video_connections` is
+    given.'''
+    def __init__(self, pool, pacer=None, video_connections=None):
+        SimpleTask.__init__(self, "StartResolver")
+        self.pool = pool
+        self.pacer = pacer
+        self.video_connections = video_connections
+
+    def process(self, item):
+        def log(message):
+            # Called from the channel thread.
+            ioloop.IOLoop.instance().add_callback(item.log_output, message)
+
+        channels = []
+        fetcher = None
+
+        if self.video_connections:
+            fetcher = videos.VideoFetcher(
+                connections=int(realize(self.video_connections, item)),
+                byte_rate=BYTE_RATE)
+            fetcher.start(item["item_dir"], log)
+            VIDEO_FETCHERS[item["item_dir"]] = fetcher
+
+        for shard in item["shards"]:
+            channel = resolver.ResolverChannel(self.pool, item["item_dir"],
+                log, name="resolver" + shard["suffix"], pacer=self.pacer,
+                fetcher=fetcher)
+            channel.start()
+            channels.append(channel)
+
+            shard["resolver_in"] = channel.in_path
+            shard["resolver_out"] = channel.out_path
+
+        RESOLVER_CHANNELS[item["item_dir"]] = channels
+
+        item["resolver_in"] = channels[0].in_path
+        item["resolver_out"] = channels[0].out_path
+
+
+class StopResolver(ThreadedTask):
+    '''Stops the resolver channels of the item. A channel can take a few
+    seconds to notice, so they are all told first and then waited for,
+    off the event loop.'''
     def __init__(self):
-        SimpleTask.__init__(self, "MoveFiles")
+        ThreadedTask.__init__(self, "StopResolver")
+
+    def process(self, item):
+        channels = RESOLVER_CHANNELS.pop(item["item_dir"], [])
+
+        for channel in channels:
+            channel.stop(wait=False)
+
+        for channel in channels:
+            channel.stop()
+
+
+class FetchVideos(ThreadedTask):
+    '''Waits for the videos StartResolver began fetching, and fetches
+    any listed ones left from an earlier run. See videos.py.'''
+    def __init__(self, connections):
+        ThreadedTask.__init__(self, "FetchVideos")
+        self.connections = connections
+
+    def process(self, item):
+        fetcher = VIDEO_FETCHERS.pop(item["item_dir"], None)
+
+        if not fetcher:
+            fetcher = videos.VideoFetcher(
+                connections=int(realize(self.connections, item)),
+                byte_rate=BYTE_RATE)
+            fetcher.start(item["item_dir"],
+                lambda message: self.log(item, message))
+
+        fetcher.add_listed()
+        count = fetcher.join()
+
+        self.log(item, "Fetched %d videos.\n" % count)
+
+
+class CompressSegments(ThreadedTask):
+    '''Compresses the segments that wget wrote uncompressed, in
+    `threads` threads at `level`. See compression.py.'''
+    def __init__(self, threads, level):
+        ThreadedTask.__init__(self, "CompressSegments")
+        self.threads = threads
+        self.level = level
+
+    def process(self, item):
+        item_checkpoint = checkpoint.Checkpoint(item["item_dir"])
+        compressor = compression.WarcCompressor(
+            level=int(realize(self.level, item)),
+            threads=max(1, int(realize(self.threads, item))))
+
+        for name in item_checkpoint.segment_names():
+            raw_path = item_checkpoint.raw_segment_path(name)
+
+            if not os.path.exists(raw_path):
+                continue
+
+            records, raw_bytes, compressed_bytes = compressor.compress(
+                raw_path, item_checkpoint.segment_path(name))
+            os.remove(raw_path)
+
+            self.log(item, "Compressed %d records of segment %s from %d "
+                "to %d bytes.\n" % (records, name, raw_bytes,
+                compressed_bytes))
+
+
+class MergeSegments(ThreadedTask):
+    '''Joins the WARCs of all runs and shards of the item into one.'''
+    def __init__(self):
+        ThreadedTask.__init__(self, "MergeSegments")
+
+    def process(self, item):
+        item_checkpoint = checkpoint.Checkpoint(item["item_dir"])
+
+        if glob.glob(os.path.join(item_checkpoint.segment_dir, "*.warc")):
+            raise Exception('Please compile wget with zlib support!')
+
+        # The merged segment stays until RemoveCheckpoint, in case the
+        # upload fails and the item comes back.
+        os.link(item_checkpoint.merge(),
+            "%(item_dir)s/%(warc_file_base)s.warc.gz" % item)
+
+
+class UpdateDedupIndex(SimpleTask):
+    '''Adds the page requisites of the item to the index used by wget's
+    --warc-dedup. It comes after the upload, so that later items only
+    refer to records that have been archived.'''
+    def __init__(self, index):
+        SimpleTask.__init__(self, "UpdateDedupIndex")
+        self.index = index
+
+    def process(self, item):
+        self.index.open(DEDUP_INDEX_FILENAME)
+        cdx_filenames = glob.glob(os.path.join(item["item_dir"],
+            checkpoint.SEGMENT_DIR, "*.cdx"))
+        new_count = sum(self.index.add_cdx(cdx_filename)
+            for cdx_filename in cdx_filenames)
+        self.index.save()
+
+        item.log_output("%d new of %d URLs in the dedup index.\n" % (
+            new_count, len(self.index)))
+
+
+class MoveFiles(ThreadedTask):
+    def __init__(self):
+        ThreadedTask.__init__(self, "MoveFiles")
 
     def process(self, item):
         # NEW for 2014! Check if wget was compiled with zlib support
@@ -132,26 +703,319 @@ class MoveFiles(SimpleTask):
 
         files_to_upload = ["%(data_dir)s/%(warc_file_base)s.warc.gz" % item]
 
-        extra_filenames = self.find_extra_files(item)
+        # Hash everything once here; staging and the stats reuse it.
+        file_info = {}
 
-        for extra_filename in extra_filenames:
-            dirname, filename = os.path.split(extra_filename)
-            new_path = os.path.join("%(data_dir)s" % item, filename)
+        for filename in files_to_upload:
+            file_info[filename] = file_digests(filename)
 
-            os.rename(extra_filename, new_path)
-            files_to_upload.append(new_path)
+        return {
+            'file_info': file_info,
+            'files_to_upload': files_to_upload,
+            'timings': self.summarize_timings(item),
+        }
+
+    def summarize_timings(self, item):
+        events_filename = "%(item_dir)s/timings.jsonl" % item
+
+        if not os.path.exists(events_filename):
+            return metrics.summarize_events([])
+
+        events = list(metrics.read_events(events_filename))
 
-        item['files_to_upload'] = files_to_upload
+        for event in events:
+            if event.get("event") in ("url", "resolve"):
+                METRICS.add(event["event"], event["seconds"])
+                METRICS.count(event["event"] + "s")
 
-        shutil.rmtree("%(item_dir)s" % item)
+        return metrics.summarize_events(events)
 
-    def find_extra_files(self, item):
-        return glob.glob("%(item_dir)s/viddler_amf.*.warc.gz" % item)
+
+class RecordOutcomes(ThreadedTask):
+    '''Adds the dead and the archived IDs of the item to the index, once
+    the item has been uploaded.
+
+    Only definite results count: IDs that the probe found missing are
+    dead, and IDs that wget finished (see checkpoint.py) are archived
+    unless one of their URLs or their resolve failed in a way another
+    try might not.
+    '''
+    def __init__(self, outcome_index):
+        ThreadedTask.__init__(self, "RecordOutcomes")
+        self.outcome_index = outcome_index
+
+    def process(self, item):
+        probe_filenames = glob.glob("%(item_dir)s/*.probe.txt.gz" % item)
+
+        if not probe_filenames:
+            return
+
+        self.outcome_index.open(OUTCOME_INDEX_DIRNAME)
+
+        results = probe.read_results(probe_filenames[0])
+        video_urls = {}
+        failed_ids = set()
+        url_statuses = {}
+        video_bytes = collections.defaultdict(int)
+        events_filename = "%(item_dir)s/timings.jsonl" % item
+
+        if os.path.exists(events_filename):
+            events = list(metrics.read_events(events_filename))
+        else:
+            events = []
+
+        for event in events:
+            if event.get("event") == "resolve":
+                video_id = int(event["video_id"], 16)
+                video_urls[video_id] = event.get("video_urls", [])
+
+                if event.get("error"):
+                    failed_ids.add(video_id)
+
+        url_video_ids = dict((url, video_id)
+            for video_id, urls in video_urls.iteritems() for url in urls)
+
+        for event in events:
+            if event.get("event") != "url":
+                continue
+
+            match = VIDEO_ID_URL_PATTERN.search(event["url"])
+
+            if match:
+                video_id = int(match.group(1), 16)
+            else:
+                video_id = url_video_ids.get(event["url"])
+
+            if video_id is not None:
+                video_bytes[video_id] += event.get("bytes") or 0
+                # A later try of the URL replaces the earlier answer
+                url_statuses[(video_id, event["url"])] = event.get("status")
+
+        for (video_id, url), status in url_statuses.iteritems():
+            if not probe.is_final(status):
+                failed_ids.add(video_id)
+
+        self.outcome_index.add_dead(video_id
+            for video_id, status in results.iteritems()
+            if status == probe.MISS_STATUS)
+
+        done_ids = checkpoint.Checkpoint(item["item_dir"]).done_ids()
+
+        for video_id in done_ids - failed_ids:
+            if not probe.is_final(results.get(video_id)):
+                continue
+
+            self.outcome_index.add_archived(video_id, {
+                "item": item["item_name"],
+                "status": results.get(video_id),
+                "urls": video_urls.get(video_id, []),
+                "bytes": video_bytes[video_id],
+            })
+
+        self.outcome_index.save()
+
+
+class RemoveCheckpoint(ThreadedTask):
+    '''Removes the item directory once the tracker knows the item is
+    done. Until then it is kept for a reissue of the item.'''
+    def __init__(self):
+        ThreadedTask.__init__(self, "RemoveCheckpoint")
+
+    def process(self, item):
+        shutil.rmtree(item["item_dir"])
+
+
+VIDEO_ID_URL_PATTERN = re.compile(r"viddler\.com/(?:v|embed|file)/([0-9a-f]+)")
+
+
+class StagingQueue(object):
+    '''Keeps count of the finished files in data_dir waiting for upload.
+
+    Items wait in WaitForStagingSpace while the staged files take up more
+    than `budget` MiB, so downloads of new items go on during uploads
+    without filling the disk.
+
+    With a `ledger_dir`, each staged item is also written there as a file
+    holding its size, and the budget covers the items of every process
+    using the directory. Waiting items then check it every
+    `poll_interval` seconds, as other processes do not wake them.
+    '''
+    def __init__(self, budget, ledger_dir=None, poll_interval=5):
+        self.budget = budget
+        self.ledger_dir = ledger_dir
+        self.poll_interval = poll_interval
+        self._staged = {}
+        self._waiting = []
+        self._polling = False
+
+        if ledger_dir and not os.path.isdir(ledger_dir):
+            os.makedirs(ledger_dir)
+
+    def staged_bytes(self):
+        if self.ledger_dir:
+            return sum(read_staging_ledger(self.ledger_dir).itervalues())
+
+        return sum(self._staged.itervalues())
+
+    def has_space(self, item):
+        # Never block when nothing is staged, or no item could go on.
+        budget = int(realize(self.budget, item)) * 1048576
+        staged_bytes = self.staged_bytes()
+        return not staged_bytes or staged_bytes < budget
+
+    def wait(self, item, callback):
+        if not self._waiting and self.has_space(item):
+            callback()
+        else:
+            self._waiting.append((item, callback))
+            self._poll()
+
+    def stage(self, item, size):
+        self._staged[item.item_id] = size
+
+        if self.ledger_dir:
+            filename = self._ledger_filename(item)
+
+            with open(filename + ".tmp", "w") as out_file:
+                out_file.write(str(size))
+
+            os.rename(filename + ".tmp", filename)
+
+    def release(self, item):
+        if self._staged.pop(item.item_id, None) is not None:
+            if self.ledger_dir:
+                os.remove(self._ledger_filename(item))
+
+            self._wake()
+
+    def _ledger_filename(self, item):
+        return os.path.join(self.ledger_dir, "%d-%s" % (os.getpid(),
+            item.item_id))
+
+    def _poll(self):
+        if not self.ledger_dir or self._polling:
+            return
+
+        def poll():
+            self._polling = False
+            self._wake()
+            self._poll()
+
+        if self._waiting:
+            self._polling = True
+            ioloop.IOLoop.instance().add_timeout(
+                time.time() + self.poll_interval, poll)
+
+    def _wake(self):
+        while self._waiting and self.has_space(self._waiting[0][0]):
+            item, callback = self._waiting.pop(0)
+            callback()
+
+
+def read_staging_ledger(dirname):
+    '''Return the staged sizes by ledger file name, leaving out the
+    files of processes that are gone.'''
+    sizes = {}
+
+    for filename in os.listdir(dirname):
+        pid, separator, item_id = filename.partition("-")
+
+        if not separator or not pid.isdigit() or filename.endswith(".tmp"):
+            continue
+
+        try:
+            os.kill(int(pid), 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                continue
+
+        try:
+            with open(os.path.join(dirname, filename)) as in_file:
+                sizes[filename] = int(in_file.read() or 0)
+        except (IOError, ValueError):
+            continue
+
+    return sizes
+
+
+class WaitForStagingSpace(Task):
+    def __init__(self, staging_queue):
+        Task.__init__(self, "WaitForStagingSpace")
+        self.staging_queue = staging_queue
+
+    def enqueue(self, item):
+        self.start_item(item)
+        self.staging_queue.wait(item, lambda: self.complete_item(item))
+
+
+class StageFiles(SimpleTask):
+    def __init__(self, staging_queue):
+        SimpleTask.__init__(self, "StageFiles")
+        self.staging_queue = staging_queue
+
+    def process(self, item):
+        self.staging_queue.stage(item, sum(info["size"]
+            for info in item["file_info"].itervalues()))
+
+
+class ReleaseStagedFiles(SimpleTask):
+    def __init__(self, staging_queue):
+        SimpleTask.__init__(self, "ReleaseStagedFiles")
+        self.staging_queue = staging_queue
+
+    def process(self, item):
+        self.staging_queue.release(item)
 
 
 def get_hash(filename):
+    return file_digests(filename, ("sha1",))["sha1"]
+
+
+def file_digests(filename, algorithms=("sha1", "sha256"), use_mmap=False,
+        chunk_size=1048576):
+    '''Return the size and hex digests of a file.
+
+    The file is read once, in chunks, so memory use does not grow with
+    its size. With `use_mmap` the chunks are hashed straight from a
+    memory map of the file.
+    '''
+    hashers = [(name, hashlib.new(name)) for name in algorithms]
+    size = 0
+
     with open(filename, 'rb') as in_file:
-        return hashlib.sha1(in_file.read()).hexdigest()
+        file_size = os.fstat(in_file.fileno()).st_size
+
+        if use_mmap and file_size:
+            mapped = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                for offset in xrange(0, file_size, chunk_size):
+                    chunk = buffer(mapped, offset, chunk_size)
+
+                    for name, hasher in hashers:
+                        hasher.update(chunk)
+
+                size = file_size
+            finally:
+                mapped.close()
+        else:
+            while True:
+                chunk = in_file.read(chunk_size)
+
+                if not chunk:
+                    break
+
+                size += len(chunk)
+
+                for name, hasher in hashers:
+                    hasher.update(chunk)
+
+    info = {"size": size}
+
+    for name, hasher in hashers:
+        info[name] = hasher.hexdigest()
+
+    return info
 
 
 CWD = os.getcwd()
@@ -169,50 +1033,210 @@ def stats_id_function(item):
 
 
 class CustomUploadWithTracker(UploadWithTracker):
+    '''Uploads the files of several items with the same target together.
+
+    Items collect per upload target until `batch_size` of them are there
+    or the first has waited `batch_wait` seconds. At most
+    `max_concurrent` batches upload at once; items that finish meanwhile
+    join the next batch. Every item is still completed on its own.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.batch_size = kwargs.pop("batch_size", 1)
+        self.batch_wait = kwargs.pop("batch_wait", 5)
+        self.max_concurrent = kwargs.pop("max_concurrent", 1)
+        UploadWithTracker.__init__(self, *args, **kwargs)
+        self._batches = {}
+        self._batch_deadlines = {}
+        self._running = 0
+
     def process_body(self, body, item):
         data = json.loads(body)
         if "upload_target" in data:
-            inner_task = None
-
-            if re.match(r"^rsync://", data["upload_target"]):
-                item.log_output("Uploading with Rsync to %s" % data["upload_target"])
-                inner_task = RsyncUpload(data["upload_target"], realize(self.files, item), target_source_path=self.rsync_target_source_path, bwlimit=self.rsync_bwlimit, extra_args=self.rsync_extra_args, max_tries=1)
+            target = data["upload_target"]
 
-            elif re.match(r"^https?://", data["upload_target"]):
-                item.log_output("Uploading with Curl to %s" % data["upload_target"])
+            if re.match(r"^rsync://", target):
+                self._add_to_batch("rsync", target, item)
 
-                if len(self.files) != 1:
+            elif re.match(r"^https?://", target):
+                # Several files can only go to a "directory" URL
+                if len(realize(self.files, item)) != 1 and \
+                        not target.endswith("/"):
                     item.log_output("Curl expects to upload a single file.")
                     self.fail_item(item)
                     return
 
-                inner_task = CurlUpload(data["upload_target"], self.files[0], self.curl_connect_timeout, self.curl_speed_limit, self.curl_speed_time, max_tries=1)
+                self._add_to_batch("curl", target, item)
 
             else:
                 item.log_output("Received invalid upload type.")
                 self.fail_item(item)
                 return
 
-            inner_task.on_complete_item += self._inner_task_complete_item
-            inner_task.on_fail_item += self._inner_task_fail_item
-            inner_task.enqueue(item)
-
         else:
             item.log_output("Tracker did not provide an upload target.")
             self.schedule_retry(item)
 
+    def _add_to_batch(self, kind, target, item):
+        key = (kind, target)
+        batch = self._batches.setdefault(key, [])
+        batch.append(item)
+
+        if len(batch) == 1:
+            deadline = time.time() + self.batch_wait
+            self._batch_deadlines[key] = deadline
+            ioloop.IOLoop.instance().add_timeout(deadline, self._start_batches)
+
+        self._start_batches()
+
+    def _start_batches(self):
+        while self._batches:
+            lead = next(self._batches.itervalues())[0]
+
+            if self._running >= int(realize(self.max_concurrent, lead)):
+                break
+
+            batch_size = int(realize(self.batch_size, lead))
+            now = time.time()
+            ready_keys = [key for key, batch in self._batches.iteritems()
+                if len(batch) >= batch_size or
+                    self._batch_deadlines[key] <= now]
+
+            if not ready_keys:
+                break
+
+            key = ready_keys[0]
+            batch = self._batches.pop(key)
+            deadline = self._batch_deadlines.pop(key)
+
+            # Leftovers keep the deadline of the batch they came with
+            if len(batch) > batch_size:
+                self._batches[key] = batch[batch_size:]
+                self._batch_deadlines[key] = deadline
+
+            self._start_batch(key, batch[:batch_size])
+
+    def _start_batch(self, key, batch):
+        kind, target = key
+        lead = batch[0]
+        files = []
+
+        for item in batch:
+            files.extend(realize(self.files, item))
+
+        self._running += 1
+
+        if kind == "rsync":
+            for item in batch:
+                item.log_output("Uploading with Rsync to %s (%d items)" % (
+                    target, len(batch)))
+
+            # rsync recreates the directories of the files it is given, so
+            # the files of all items are linked into one directory first.
+            source_dir = tempfile.mkdtemp(prefix="upload-",
+                dir=os.path.dirname(lead["data_dir"]))
+            source_files = []
+
+            try:
+                for filename in files:
+                    source_file = os.path.join(source_dir,
+                        os.path.basename(filename))
+                    os.link(filename, source_file)
+                    source_files.append(source_file)
+            except OSError as error:
+                for item in batch:
+                    item.log_output("Could not link %s for upload: %s" % (
+                        filename, error))
+
+                shutil.rmtree(source_dir, ignore_errors=True)
+                self._batch_fail(batch)
+                return
+
+            # The upload runs on the lead item; show its output on all
+            log_outputs = [item.log_output for item in batch]
+
+            def log_output(*args, **kwargs):
+                for item_log_output in log_outputs:
+                    item_log_output(*args, **kwargs)
+
+            lead.log_output = log_output
+
+            def end_batch(end):
+                del lead.log_output
+                shutil.rmtree(source_dir, ignore_errors=True)
+                end(batch)
+
+            inner_task = RsyncUpload(target, source_files, target_source_path=source_dir + "/", bwlimit=self.rsync_bwlimit, extra_args=self.rsync_extra_args, max_tries=1)
+            inner_task.on_complete_item += \
+                lambda task, item: end_batch(self._batch_complete)
+            inner_task.on_fail_item += \
+                lambda task, item: end_batch(self._batch_fail)
+            inner_task.enqueue(lead)
+
+        else:
+            for item in batch:
+                item.log_output("Uploading with Curl to %s (%d items)" % (
+                    target, len(batch)))
+
+            self._curl_next_file(target, batch, files)
+
+    def _curl_next_file(self, target, batch, files):
+        if not files:
+            self._batch_complete(batch)
+            return
+
+        inner_task = CurlUpload(target, files[0], self.curl_connect_timeout, self.curl_speed_limit, self.curl_speed_time, max_tries=1)
+        inner_task.on_complete_item += \
+            lambda task, item: self._curl_next_file(target, batch, files[1:])
+        inner_task.on_fail_item += lambda task, item: self._batch_fail(batch)
+        inner_task.enqueue(batch[0])
+
+    def _batch_complete(self, batch):
+        self._running -= 1
+
+        for item in batch:
+            self._inner_task_complete_item(None, item)
+
+        self._start_batches()
+
+    def _batch_fail(self, batch):
+        self._running -= 1
+
+        for item in batch:
+            self._inner_task_fail_item(None, item)
+
+        self._start_batches()
+
 
 class CustomPrepareStatsForTracker(PrepareStatsForTracker):
     def process(self, item):
+        # Sizes are known for files that MoveFiles has hashed
+        file_info = item["file_info"] if "file_info" in item else {}
+
+        def get_size(filename):
+            if filename in file_info:
+                return file_info[filename]["size"]
+
+            return os.path.getsize(filename)
+
         total_bytes = {}
         for (group, files) in self.file_groups.iteritems():
-            total_bytes[group] = sum([os.path.getsize(realize(f, item)) for f in realize(files, item)])
+            total_bytes[group] = sum([get_size(realize(f, item)) for f in realize(files, item)])
 
         stats = {}
         stats.update(self.defaults)
         stats["item"] = item["item_name"]
         stats["bytes"] = total_bytes
 
+        if "timings" in item:
+            timings = dict(item["timings"])
+            timings["stages"] = item["stage_seconds"] \
+                if "stage_seconds" in item else {}
+            stats["timings"] = timings
+
+        if file_info:
+            stats["files"] = dict((os.path.basename(filename), info)
+                for filename, info in file_info.iteritems())
+
         if self.id_function:
             stats["id"] = self.id_function(item)
 
@@ -220,15 +1244,83 @@ class CustomPrepareStatsForTracker(PrepareStatsForTracker):
 
 
 class WgetArgs(object):
+    def __init__(self, accept_on_exit_code, compression_threads=0):
+        self.accept_on_exit_code = accept_on_exit_code
+        self.compression_threads = compression_threads
+
     def realize(self, item):
+        if 'bind_address' in globals():
+            print('')
+            print('*** Wget will bind address at {0} ***'.format(
+                globals()['bind_address']))
+            print('')
+
+        # Each run writes new WARC segments and fetches only the IDs that
+        # earlier runs of the item have not finished.
+        item_checkpoint = checkpoint.Checkpoint(item["item_dir"])
+        done_ids = item_checkpoint.done_ids()
+        attempt = item_checkpoint.next_attempt()
+        shards = []
+
+        for shard in item["shards"]:
+            # Shards without live IDs left have nothing to fetch.
+            if self.write_todo_file(item, shard, done_ids):
+                shard["warc_segment"] = item_checkpoint.new_segment_name(
+                    attempt, shard["suffix"])
+                shards.append(shard)
+
+        if len(shards) == 1:
+            item["warc_segment"] = shards[0]["warc_segment"]
+            return self.shard_args(item, shards[0])
+
+        item["warc_segment"] = ""
+
+        # Several wget processes are run by a helper script
+        shards_filename = "%(item_dir)s/shards.json" % item
+
+        with open(shards_filename, "w") as out_file:
+            json.dump({
+                "accept_on_exit_code": self.accept_on_exit_code,
+                "shards": [
+                    {
+                        "args": self.shard_args(item, shard),
+                        "env": {
+                            "resolver_in": shard["resolver_in"],
+                            "resolver_out": shard["resolver_out"],
+                            "warc_segment": shard["warc_segment"],
+                        },
+                    }
+                    for shard in shards
+                ],
+            }, out_file)
+
+        return [sys.executable, "wget_shards.py", shards_filename]
+
+    def write_todo_file(self, item, shard, done_ids):
+        '''Write the URLs the shard still has to fetch and return how many
+        there are.'''
+        if "input_file" in shard:
+            video_ids = read_url_file(shard["input_file"])
+        else:
+            video_ids = xrange(shard["start"], shard["end"] + 1)
+
+        todo_filename = "%s/todo%s.txt" % (item["item_dir"], shard["suffix"])
+        shard["todo_file"] = todo_filename
+
+        return write_url_file(todo_filename, (video_id
+            for video_id in video_ids if video_id not in done_ids))
+
+    def shard_args(self, item, shard):
+        suffix = shard["suffix"]
         wget_args = [
             WGET_LUA,
             "-U", "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/32.0.1700.76 Safari/537.36",
             "-nv",
-            "-o", ItemInterpolation("%(item_dir)s/wget.log"),
+            "-o", ItemInterpolation("%(item_dir)s/wget" + suffix + ".log"),
             "--lua-script", "viddler.lua",
             "--no-check-certificate",
-            "--output-document", ItemInterpolation("%(item_dir)s/wget.tmp"),
+            "--output-document",
+                ItemInterpolation("%(item_dir)s/wget" + suffix + ".tmp"),
             "--truncate-output",
             "-e", "robots=off",
             "--no-cookies",
@@ -241,37 +1333,32 @@ class WgetArgs(object):
             "--no-parent",
             "--waitretry", "3600",
             "--domains", "viddler.com",
-            "--warc-file",
-                ItemInterpolation("%(item_dir)s/%(warc_file_base)s"),
+            "--warc-file", os.path.join(item["item_dir"],
+                checkpoint.SEGMENT_DIR, shard["warc_segment"]),
             "--warc-header", "operator: Archive Team",
             "--warc-header", "viddler-dld-script-version: " + VERSION,
             "--warc-header", ItemInterpolation("viddler-user: %(item_name)s"),
+            "--warc-cdx",
         ]
 
-        item_name = item['item_name']
-        start, end = item_name.split(':', 1)
-        start = int(start)
-        end = int(end)
+        # CompressSegments does it instead, off wget's download thread
+        if int(realize(self.compression_threads, item)):
+            wget_args.append("--no-warc-compression")
 
-        assert start <= end
+        # Requisites that earlier items already have become revisit records
+        if os.path.exists(DEDUP_INDEX_FILENAME):
+            wget_args.extend(["--warc-dedup", DEDUP_INDEX_FILENAME])
 
-        for video_id_num in range(start, end + 1):
-            # Note: it appears viddler doesn't use leading 0 padding so
-            # don't include it
-            video_id_str = '{0:x}'.format(video_id_num)
-
-            wget_args.append('http://www.viddler.com/v/%s' % video_id_str)
+        wget_args.extend(["--input-file", shard["todo_file"]])
 
         if 'bind_address' in globals():
             wget_args.extend(['--bind-address', globals()['bind_address']])
-            print('')
-            print('*** Wget will bind address at {0} ***'.format(
-                globals()['bind_address']))
-            print('')
 
         return realize(wget_args, item)
 
 
+WGET_ACCEPT_ON_EXIT_CODE = [0, 8]
+
 downloader = globals()['downloader']  # quiet the code checker
 
 ###########################################################################
@@ -292,20 +1379,63 @@ project = Project(
     utc_deadline=datetime.datetime(year=2014, month=3, day=11)
 )
 
+METRICS = metrics.Metrics()
+
+if 'metrics_port' in globals():
+    metrics.serve_metrics(METRICS, int(globals()['metrics_port']))
+
+STAGING_QUEUE = StagingQueue(NumberConfigValue(min=64, max=1048576,
+    default="4096", name="viddler:staging_budget", title="Staging space",
+    description="MiB of finished files to keep waiting for upload before "
+        "starting new items."),
+    ledger_dir=globals().get('staging_ledger'))
+
+COMPRESSION_THREADS = NumberConfigValue(min=0, max=32, default="0",
+    name="viddler:compression_threads", title="Compression threads",
+    description="Threads that compress the WARCs after wget, instead of "
+        "wget compressing them while it downloads. 0 leaves it to wget.")
+
+VIDEO_CONNECTIONS = NumberConfigValue(min=1, max=16, default="4",
+    name="viddler:video_connections", title="Video connections",
+    description="The number of connections used to download videos.")
+
 pipeline = Pipeline(
-    GetItemFromTracker("http://%s/%s" % (TRACKER_HOST, TRACKER_ID), downloader,
-        VERSION),
-    PrepareDirectories(warc_prefix="viddler"),
+    WaitForStagingSpace(STAGING_QUEUE),
+    GetItemFromTracker(TRACKER_URL, downloader, VERSION),
+    PrepareDirectories(warc_prefix="viddler",
+        shard_count=NumberConfigValue(min=1, max=8, default="1",
+            name="viddler:wget_shards", title="Wget processes",
+            description="The number of wget processes to split each item across.")),
+    ProbeIDs(concurrency=NumberConfigValue(min=1, max=32, default="8",
+        name="viddler:probe_concurrency", title="Probe connections",
+        description="The number of connections used to find live video IDs."),
+        outcome_index=OUTCOME_INDEX),
+    SalvageSegments(),
+    StartResolver(RESOLVER_POOL, HOST_PACER,
+        video_connections=VIDEO_CONNECTIONS),
     WgetDownload(
-        WgetArgs(),
+        WgetArgs(accept_on_exit_code=WGET_ACCEPT_ON_EXIT_CODE,
+            compression_threads=COMPRESSION_THREADS),
         max_tries=5,
-        accept_on_exit_code=[0, 8],
+        accept_on_exit_code=WGET_ACCEPT_ON_EXIT_CODE,
         env={
             'item_name': ItemValue("item_name"),
             'item_dir': ItemValue("item_dir"),
+            'resolver_in': ItemValue("resolver_in"),
+            'resolver_out': ItemValue("resolver_out"),
+            'warc_segment': ItemValue("warc_segment"),
         }
     ),
+    SalvageSegments("SalvageWgetSegments", wget_only=True),
+    StopResolver(),
+    FetchVideos(connections=VIDEO_CONNECTIONS),
+    CompressSegments(COMPRESSION_THREADS,
+        level=NumberConfigValue(min=1, max=9, default="6",
+            name="viddler:compression_level", title="Compression level",
+            description="The gzip level of WARCs compressed after wget.")),
+    MergeSegments(),
     MoveFiles(),
+    StageFiles(STAGING_QUEUE),
     CustomPrepareStatsForTracker(
         defaults={"downloader": downloader, "version": VERSION},
         file_groups={
@@ -313,24 +1443,50 @@ pipeline = Pipeline(
         },
         id_function=stats_id_function,
     ),
-    LimitConcurrent(NumberConfigValue(min=1, max=4, default="1",
-        name="shared:rsync_threads", title="Rsync threads",
-        description="The maximum number of concurrent uploads."),
-        CustomUploadWithTracker(
-            "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
-            downloader=downloader,
-            version=VERSION,
-            files=ItemValue("files_to_upload"),
-            rsync_target_source_path=ItemInterpolation("%(data_dir)s/"),
-            rsync_extra_args=[
-                "--recursive",
-                "--partial",
-                "--partial-dir", ".rsync-tmp"
-            ]
-            ),
+    CustomUploadWithTracker(
+        TRACKER_URL,
+        downloader=downloader,
+        version=VERSION,
+        files=ItemValue("files_to_upload"),
+        rsync_extra_args=[
+            "--recursive",
+            "--partial",
+            "--partial-dir", ".rsync-tmp"
+        ],
+        batch_size=NumberConfigValue(min=1, max=50, default="10",
+            name="viddler:upload_batch_size", title="Upload batch size",
+            description="The maximum number of items to upload together."),
+        max_concurrent=NumberConfigValue(min=1, max=4, default="1",
+            name="shared:rsync_threads", title="Rsync threads",
+            description="The maximum number of concurrent uploads."),
     ),
+    UpdateDedupIndex(DEDUP_INDEX),
+    ReleaseStagedFiles(STAGING_QUEUE),
     SendDoneToTracker(
-        tracker_url="http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+        tracker_url=TRACKER_URL,
         stats=ItemValue("stats")
-    )
+    ),
+    RecordOutcomes(OUTCOME_INDEX),
+    RemoveCheckpoint()
 )
+
+StageTimer(METRICS).attach(pipeline.tasks)
+
+# Failed items do not reach ReleaseStagedFiles
+pipeline.on_finish_item += lambda pipeline, item: STAGING_QUEUE.release(item)
+
+
+def stop_item_resolver(pipeline, item):
+    '''Failed items do not reach StopResolver and FetchVideos.'''
+    if "item_dir" not in item:
+        return
+
+    for channel in RESOLVER_CHANNELS.pop(item["item_dir"], []):
+        channel.stop(wait=False)
+
+    fetcher = VIDEO_FETCHERS.pop(item["item_dir"], None)
+
+    if fetcher:
+        fetcher.stop()
+
+pipeline.on_finish_item += stop_item_resolver
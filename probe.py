@@ -0,0 +1,176 @@
+'''Check which video IDs exist before handing them to wget.
+
+Most of the ID space is empty, so a quick HEAD request for each
+``/v/<hex>`` page lets the pipeline give wget only the live IDs.
+'''
+from __future__ import print_function
+
+import gzip
+import httplib
+import Queue
+import socket
+import threading
+
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/32.0.1700.76 Safari/537.36'
+VIDEO_HOST = 'www.viddler.com'
+VIDEO_PATH = '/v/{0:x}'
+VIDEO_URL = 'http://' + VIDEO_HOST + VIDEO_PATH
+
+MISS_STATUS = 404
+
+
+def video_url(video_id):
+    return VIDEO_URL.format(video_id)
+
+
+class Prober(object):
+    '''Probes video IDs with a bounded number of keep-alive connections.'''
+    def __init__(self, concurrency=8, timeout=30, host=VIDEO_HOST,
+            path=VIDEO_PATH, throttle=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.host = host
+        self.path = path
+        self.throttle = throttle
+
+    def probe(self, video_ids, callback=None):
+        '''Return a dict of video ID to HTTP status.
+
+        The status is None if the request failed. `callback` is called
+        with each ID and status from the probing threads as they come
+        in, and `throttle`, if given, before every request.
+        '''
+        video_ids = list(video_ids)
+        queue = Queue.Queue()
+        results = {}
+
+        for video_id in video_ids:
+            queue.put(video_id)
+
+        threads = []
+
+        for dummy in range(min(self.concurrency, len(video_ids))):
+            thread = threading.Thread(target=self._run,
+                args=(queue, results, callback))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def _run(self, queue, results, callback):
+        connection = None
+
+        while True:
+            try:
+                video_id = queue.get_nowait()
+            except Queue.Empty:
+                break
+
+            if self.throttle:
+                self.throttle()
+
+            if not connection:
+                connection = httplib.HTTPConnection(self.host,
+                    timeout=self.timeout)
+
+            try:
+                connection.request('HEAD', self.path.format(video_id),
+                    headers={'User-Agent': USER_AGENT})
+                response = connection.getresponse()
+                response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                connection = None
+                results[video_id] = None
+            else:
+                results[video_id] = response.status
+
+                if response.getheader('connection', '').lower() == 'close':
+                    connection.close()
+                    connection = None
+
+            if callback:
+                callback(video_id, results[video_id])
+
+        if connection:
+            connection.close()
+
+
+def is_live(status):
+    '''Whether wget should fetch an ID with this probe status.
+
+    Only a 404 is a definite miss; errors are left for wget to retry.
+    '''
+    return status != MISS_STATUS
+
+
+def is_final(status):
+    '''Whether asking again would most likely give the same answer.'''
+    return status is not None and 200 <= status < 500 and \
+        status not in (403, 408, 429)
+
+
+def format_results(results):
+    '''Return probe results as runs of consecutive IDs with one status.
+
+    Each line is ``<first hex>-<last hex> <status>``, where the status is
+    ``error`` if the request failed.
+    '''
+    lines = []
+
+    for first, last, status in status_runs(results):
+        if status is None:
+            status = 'error'
+
+        lines.append('{0:x}-{1:x} {2}\n'.format(first, last, status))
+
+    return ''.join(lines)
+
+
+def write_results(filename, results):
+    '''Write probe results in the format of format_results.'''
+    with gzip.open(filename, 'wb') as out_file:
+        out_file.write(format_results(results))
+
+
+def read_results(filename):
+    '''Read the results written by write_results.'''
+    results = {}
+
+    with gzip.open(filename, 'rb') as in_file:
+        for line in in_file:
+            id_range, status = line.split()
+            first, last = id_range.split('-')
+
+            if status == 'error':
+                status = None
+            else:
+                status = int(status)
+
+            for video_id in xrange(int(first, 16), int(last, 16) + 1):
+                results[video_id] = status
+
+    return results
+
+
+def status_runs(results):
+    run = None
+
+    for video_id in sorted(results):
+        status = results[video_id]
+
+        if run and run[1] + 1 == video_id and run[2] == status:
+            run[1] = video_id
+        else:
+            if run:
+                yield tuple(run)
+
+            run = [video_id, video_id, status]
+
+    if run:
+        yield tuple(run)
@@ -0,0 +1,416 @@
+'''In-process pool of riddler resolvers.
+
+Instead of forking ``./riddler.py --wget <id>`` for every embed, the
+pipeline keeps a few warm worker threads that talk to the AMF gateway
+over keep-alive connections. The Lua hook reaches the pool through a pair
+of named pipes in the item directory:
+
+* it writes one video ID per line to ``resolver.in``, and
+* it reads the resolved URLs, one per line, from ``resolver.out``. An
+  empty line ends the answer.
+
+In the pipeline the hook writes ``queue <id>`` instead and gets an empty
+answer at once. The video is resolved in the background and handed to
+the item's :class:`videos.VideoFetcher`, so the downloads start within
+the lifetime of their tokens and wget-lua never waits for the gateway.
+
+The hook also reports the result of each request with a line of
+``pace <host> <status> <seconds> <bytes>``. The empty answer comes once
+the pacer (see pacing.py) allows the next request to that host, so
+wget-lua waits without forking ``sleep``.
+
+Each wget-lua process of a sharded item gets its own pair of pipes.
+'''
+from __future__ import print_function
+
+import collections
+import errno
+import httplib
+import os
+import Queue
+import select
+import socket
+import sys
+import threading
+import time
+import traceback
+import urlparse
+
+import metrics
+import riddler
+import videos
+
+
+class GatewaySession(object):
+    '''A keep-alive HTTP connection to the AMF gateway.'''
+    def __init__(self, url=None, timeout=60):
+        self.url = url or riddler.GATEWAY_URL
+        self.host = urlparse.urlsplit(self.url).netloc
+        self.timeout = timeout
+        self._connection = None
+
+    def post(self, payload):
+        '''Return the :class:`riddler.Exchange` of the request.'''
+        # A kept-alive connection may have been closed by the server
+        # in the meantime, so try once more on a fresh one.
+        for attempt in range(2):
+            if not self._connection:
+                self._connection = httplib.HTTPConnection(
+                    self.host, timeout=self.timeout)
+
+            try:
+                exchange = riddler.post_gateway(self._connection, payload,
+                    self.url)
+            except (httplib.HTTPException, socket.error):
+                self.close()
+
+                if attempt:
+                    raise
+            else:
+                if exchange.status != 200:
+                    self.close()
+                    raise Exception('Gateway returned status {0}.'.format(
+                        exchange.status))
+
+                if exchange.will_close:
+                    self.close()
+
+                return exchange
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+
+class ResolveJob(object):
+    def __init__(self, video_id, item_dir=None, callback=None):
+        self.video_id = video_id
+        self.item_dir = item_dir
+        self.callback = callback
+        self.urls = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self):
+        try:
+            if self.callback:
+                self.callback(self)
+        finally:
+            self.done.set()
+
+    def wait(self):
+        self.done.wait()
+
+        if self.error:
+            raise self.error
+
+        return self.urls
+
+
+class ResolverPool(object):
+    '''Worker threads that resolve video IDs to CDN URLs.
+
+    Each worker owns a :class:`GatewaySession` so connections to the
+    gateway are reused across videos and items. Jobs that are waiting in
+    the queue together are sent to the gateway as one batched envelope of
+    up to `batch_size` calls. Videos resolved recently enough are taken
+    from ``riddler.RESOLVED_CACHE`` instead.
+    '''
+    def __init__(self, size=2, batch_size=10):
+        self.size = size
+        self.batch_size = batch_size
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads
+                if thread.is_alive()]
+
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, video_id, item_dir=None, callback=None):
+        '''Queue a video and return its job. `callback` is called with
+        the job from the worker thread once it is done.'''
+        self.start()
+        job = ResolveJob(video_id, item_dir, callback)
+        self._queue.put(job)
+        return job
+
+    def resolve(self, video_id, item_dir=None):
+        return self.submit(video_id, item_dir).wait()
+
+    def _run(self):
+        session = GatewaySession()
+
+        while True:
+            jobs = [self._queue.get()]
+
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            try:
+                self._resolve(session, jobs)
+            except Exception as error:
+                for job in jobs:
+                    if job.urls is None and not job.error:
+                        job.error = error
+            finally:
+                # A failing callback must not take the worker or the
+                # rest of the batch with it
+                for job in jobs:
+                    try:
+                        job.finish()
+                    except Exception:
+                        print('Callback for {0} failed:'.format(
+                            job.video_id), file=sys.stderr)
+                        traceback.print_exc()
+
+    def _resolve(self, session, jobs):
+        resolved = {}
+        video_ids = []
+
+        for job in jobs:
+            if job.video_id in resolved or job.video_id in video_ids:
+                continue
+
+            cached = riddler.RESOLVED_CACHE.get(job.video_id)
+
+            if cached:
+                resolved[job.video_id] = cached
+            else:
+                video_ids.append(job.video_id)
+
+        if video_ids:
+            request_payload = riddler.video_info_batch_request(video_ids)
+            exchange = session.post(request_payload)
+            envelope = riddler.read_response_payload(exchange.payload)
+            results = riddler.process_batch_envelope(envelope, video_ids)
+
+            for video_id in video_ids:
+                result = results[video_id]
+
+                if not isinstance(result, Exception):
+                    result = riddler.Resolved(video_id, result, exchange)
+                    riddler.RESOLVED_CACHE.put(result)
+
+                resolved[video_id] = result
+
+        # A batch may mix videos from several items, so each exchange is
+        # recorded once in the WARC of every item with videos in it.
+        recordings = collections.OrderedDict()
+
+        for job in jobs:
+            result = resolved[job.video_id]
+
+            if isinstance(result, Exception):
+                job.error = result
+            elif job.item_dir:
+                exchange, video_urls, item_jobs = recordings.setdefault(
+                    (job.item_dir, id(result.exchange)),
+                    (result.exchange, {}, []))
+                video_urls[job.video_id] = result.urls
+                item_jobs.append(job)
+            else:
+                job.urls = result.urls
+
+        for (item_dir, exchange_id), (exchange, video_urls, item_jobs) \
+                in recordings.iteritems():
+            try:
+                riddler.record_exchange(item_dir, exchange, video_urls)
+            except Exception as error:
+                for job in item_jobs:
+                    job.error = error
+            else:
+                for job in item_jobs:
+                    job.urls = video_urls[job.video_id]
+
+
+class ResolverChannel(object):
+    '''Serves resolve requests from one wget-lua process over named pipes.'''
+    POLL_INTERVAL = 5
+
+    def __init__(self, pool, item_dir, log=None, name='resolver',
+            pacer=None, fetcher=None):
+        self.pool = pool
+        self.pacer = pacer
+        self.fetcher = fetcher
+        self.item_dir = item_dir
+        self.in_path = os.path.join(item_dir, name + '.in')
+        self.out_path = os.path.join(item_dir, name + '.out')
+        self.events_path = os.path.join(item_dir, 'timings.jsonl')
+        self._log = log
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # A resumed item can still have the pipes of its earlier run
+        for path in (self.in_path, self.out_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+        os.mkfifo(self.in_path)
+        os.mkfifo(self.out_path)
+
+        # Opening both ends read-write keeps the pipes from blocking on
+        # open and from reporting EOF whenever wget-lua goes away.
+        self._in_fd = os.open(self.in_path, os.O_RDWR | os.O_NONBLOCK)
+        self._out_fd = os.open(self.out_path, os.O_RDWR)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=True):
+        self._stopped.set()
+
+        if self.pacer:
+            self.pacer.forget(self.item_dir)
+
+        if self._thread and wait:
+            self._thread.join()
+            self._thread = None
+
+    def log(self, message):
+        if self._log:
+            self._log(message)
+
+    def _run(self):
+        buffer = b''
+
+        try:
+            while not self._stopped.is_set():
+                # Removing the item directory also ends the channel
+                if not os.path.exists(self.in_path):
+                    break
+
+                readable = select.select(
+                    [self._in_fd], [], [], self.POLL_INTERVAL)[0]
+
+                if not readable:
+                    continue
+
+                try:
+                    data = os.read(self._in_fd, 4096)
+                except OSError as error:
+                    if error.errno == errno.EAGAIN:
+                        continue
+                    raise
+
+                buffer += data
+
+                while b'\n' in buffer:
+                    line, buffer = buffer.split(b'\n', 1)
+                    self._serve(line)
+        except Exception:
+            self.log('Resolver channel {0} failed:\n{1}'.format(
+                self.in_path, traceback.format_exc()))
+        finally:
+            os.close(self._in_fd)
+            os.close(self._out_fd)
+
+    def _serve(self, line):
+        '''Answer one line of wget-lua. The answer always ends with an
+        empty line, even if the request failed, or wget-lua would wait
+        for it forever.'''
+        urls = []
+
+        try:
+            parts = line.decode('ascii').split()
+
+            if len(parts) in (4, 5) and parts[0] == 'pace':
+                self._pace(parts[1], int(parts[2]), float(parts[3]),
+                    int(parts[4]) if len(parts) == 5 else 0)
+            elif len(parts) == 2 and parts[0] == 'queue':
+                self._queue(parts[1])
+            elif parts:
+                urls = self._answer(parts[0])
+        except Exception:
+            self.log('Request {0!r} failed:\n{1}'.format(line,
+                traceback.format_exc()))
+
+        response = ''.join(url + '\n' for url in urls) + '\n'
+        os.write(self._out_fd, response.encode('ascii'))
+
+    def _pace(self, host, status, seconds, byte_count=0):
+        if self.pacer:
+            delay = self.pacer.pace(host, status, seconds, byte_count,
+                item=self.item_dir)
+
+            if delay > 0:
+                time.sleep(delay)
+
+    def _answer(self, video_id):
+        start_time = time.time()
+
+        try:
+            urls = self.pool.resolve(video_id, self.item_dir)
+        except Exception as error:
+            self.log('Resolving {0} failed:\n{1}'.format(
+                video_id, traceback.format_exc()))
+            self._resolved(video_id, [], start_time, error)
+            return []
+
+        self.log('Resolved {0} to {1} URLs.'.format(video_id, len(urls)))
+        self._resolved(video_id, urls, start_time)
+
+        return urls
+
+    def _queue(self, video_id):
+        '''Resolve in the background and hand the URLs to the fetcher,
+        so wget-lua can go on at once.'''
+        start_time = time.time()
+
+        def callback(job):
+            try:
+                if job.error:
+                    self.log('Resolving {0} failed: {1}'.format(
+                        video_id, job.error))
+                else:
+                    self.log('Queued {0} URLs of {1}.'.format(
+                        len(job.urls), video_id))
+
+                self._resolved(video_id, job.urls or [], start_time,
+                    job.error)
+            finally:
+                if self.fetcher:
+                    self.fetcher.release()
+
+        if self.fetcher:
+            self.fetcher.hold()
+
+        try:
+            self.pool.submit(video_id, self.item_dir, callback)
+        except Exception:
+            if self.fetcher:
+                self.fetcher.release()
+            raise
+
+    def _resolved(self, video_id, urls, start_time, error=None):
+        event = {
+            'event': 'resolve',
+            'video_id': video_id,
+            'urls': len(urls),
+            'video_urls': urls,
+            'seconds': time.time() - start_time,
+        }
+
+        if error:
+            event['error'] = str(error)
+
+        metrics.append_event(self.events_path, event)
+
+        if urls:
+            videos.add_video(self.item_dir, video_id, urls)
+
+            if self.fetcher:
+                self.fetcher.add(video_id, urls)
@@ -9,38 +9,47 @@ For more info, please see:
 '''
 from __future__ import print_function
 
-from Crypto.Cipher import Blowfish
 import argparse
+import collections
+import httplib
 import json
 import os.path
-import subprocess
+import socket
 import sys
-import tempfile
+import threading
 import time
-import urllib2
 import urlparse
 
-import pyamf.remoting
+import checkpoint
+import warcwriter
 
 
 VERSION = '20140220.01'
 USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/32.0.1700.76 Safari/537.36'
+GATEWAY_URL = 'http://www.viddler.com/amfgateway.action'
 
 
 def main():
     arg_parser = argparse.ArgumentParser()
-    arg_parser.add_argument('video_id')
-    arg_parser.add_argument('--wget', action='store_true')
+    arg_parser.add_argument('video_id', nargs='+')
+    arg_parser.add_argument('--wget', action='store_true',
+        help='record the gateway request in the WARC of $item_dir')
     args = arg_parser.parse_args()
 
     print('% RiDDLeR v1.0 ViDDLeR DeCRYPToR %', file=sys.stderr)
 
+    if len(args.video_id) > 1:
+        batch_main(args)
+        return
+
+    video_id = args.video_id[0]
+
     print('% Request riddle..', file=sys.stderr)
-    request_payload = video_info_request(args.video_id)
+    request_payload = video_info_request(video_id)
 
     print('% Cracking riddle..', file=sys.stderr)
-    response_payload = make_info_request(request_payload)
-    envelope = read_response_payload(response_payload)
+    exchange = make_info_request(request_payload)
+    envelope = read_response_payload(exchange.payload)
     paths = list(process_envelope(envelope))
 
     print('% Cracked', len(paths), 'URLs!', file=sys.stderr)
@@ -51,42 +60,202 @@ def main():
     if args.wget:
         print('% Recording WARC..', file=sys.stderr)
         item_dir = os.environ['item_dir']
-        run_wget(args.video_id, request_payload, item_dir, paths)
+        record_exchange(item_dir, exchange, {video_id: paths})
+
+    print('% Done.', file=sys.stderr)
+
+
+def batch_main(args):
+    '''Resolve several videos with one gateway request.
+
+    Prints one ``video_id<TAB>url`` line per URL.
+    '''
+    print('% Request', len(args.video_id), 'riddles..', file=sys.stderr)
+    request_payload = video_info_batch_request(args.video_id)
+
+    print('% Cracking riddles..', file=sys.stderr)
+    exchange = make_info_request(request_payload)
+    envelope = read_response_payload(exchange.payload)
+    results = process_batch_envelope(envelope, args.video_id)
+
+    all_paths = []
+    video_urls = {}
+
+    for video_id in args.video_id:
+        paths = results[video_id]
+
+        if isinstance(paths, Exception):
+            print('% Failed', video_id, paths, file=sys.stderr)
+            continue
+
+        for path in paths:
+            print(video_id, path, sep='\t')
+
+        all_paths.extend(paths)
+        video_urls[video_id] = paths
+
+    print('% Cracked', len(all_paths), 'URLs!', file=sys.stderr)
+
+    if args.wget:
+        print('% Recording WARC..', file=sys.stderr)
+        item_dir = os.environ['item_dir']
+        record_exchange(item_dir, exchange, video_urls)
 
     print('% Done.', file=sys.stderr)
 
 
 def video_info_request(video_id):
-    req = pyamf.remoting.Request(
-        'viddlerGateway.getVideoInfo',
-        [video_id, None, None, "false"])
-    envelope = pyamf.remoting.Envelope(amfVersion=0)
-    envelope.bodies.append(('/1', req))
-    stream = pyamf.remoting.encode(envelope)
+    return video_info_batch_request([video_id])
+
+
+def video_info_batch_request(video_ids):
+    '''Encode one getVideoInfo call per video into a single envelope.
+
+    The calls are keyed ``/1``, ``/2``, ... in the order of `video_ids`.
+    '''
+    remoting = amf_remoting()
+    envelope = remoting.Envelope(amfVersion=0)
+
+    for index, video_id in enumerate(video_ids, 1):
+        req = remoting.Request(
+            'viddlerGateway.getVideoInfo',
+            [video_id, None, None, "false"])
+        envelope.bodies.append(('/{0}'.format(index), req))
+
+    stream = remoting.encode(envelope)
 
     return stream.read()
 
 
 def make_info_request(payload):
-    headers = {
-        'Content-Type': 'application/x-amf',
-        'User-Agent': USER_AGENT,
-    }
-    request = urllib2.Request('http://www.viddler.com/amfgateway.action',
-        headers=headers, data=payload)
-    response = urllib2.urlopen(request)
+    '''POST the payload to the gateway and return the :class:`Exchange`.'''
+    connection = httplib.HTTPConnection(urlparse.urlsplit(GATEWAY_URL).netloc,
+        timeout=60)
+
+    try:
+        exchange = post_gateway(connection, payload)
+    finally:
+        connection.close()
+
+    if exchange.status != 200:
+        raise Exception('Gateway returned status {0}.'.format(
+            exchange.status))
+
+    return exchange
+
+
+class Exchange(object):
+    '''A gateway request and its response, as sent and received.
+
+    `payload` is the body of the response without any transfer encoding.
+    '''
+    def __init__(self, url, request, response, payload, status,
+            will_close=False, ip_address=None):
+        self.url = url
+        self.request = request
+        self.response = response
+        self.payload = payload
+        self.status = status
+        self.will_close = will_close
+        self.ip_address = ip_address
+        self.date = warcwriter.warc_date()
+
+
+def post_gateway(connection, payload, url=GATEWAY_URL):
+    '''POST the payload over an httplib connection and return the
+    :class:`Exchange`.'''
+    url_info = urlparse.urlsplit(url)
+    headers = [
+        ('Host', url_info.netloc),
+        ('User-Agent', USER_AGENT),
+        ('Content-Type', 'application/x-amf'),
+        ('Content-Length', len(payload)),
+    ]
+
+    # Headers are given one by one so the request is recorded as sent
+    connection.putrequest('POST', url_info.path, skip_host=True,
+        skip_accept_encoding=True)
+
+    for name, value in headers:
+        connection.putheader(name, value)
+
+    connection.endheaders(payload)
+
+    response = connection.getresponse()
+    body = response.read()
+
+    try:
+        ip_address = connection.sock.getpeername()[0]
+    except (AttributeError, socket.error):
+        ip_address = None
+
+    request = 'POST {0} HTTP/1.1\r\n{1}\r\n'.format(url_info.path,
+        warcwriter.warc_fields(headers)) + payload
+
+    return Exchange(url, request, http_response_bytes(response, body), body,
+        response.status, response.will_close, ip_address)
+
+
+def http_response_bytes(response, body):
+    '''Put an httplib response back together.'''
+    version = 'HTTP/1.0' if response.version == 10 else 'HTTP/1.1'
+    header_lines = [line.rstrip('\r\n') + '\r\n'
+        for line in response.msg.headers]
+
+    # httplib has taken the chunks apart, so send it as one chunk
+    if response.chunked and body:
+        body = '{0:x}\r\n{1}\r\n0\r\n\r\n'.format(len(body), body)
+    elif response.chunked:
+        body = '0\r\n\r\n'
+
+    return '{0} {1} {2}\r\n{3}\r\n'.format(version, response.status,
+        response.reason, ''.join(header_lines)) + body
 
-    return response.read()
+
+def amf_remoting():
+    '''Import pyamf when it is first needed; it is slow to load.'''
+    import pyamf.remoting
+
+    return pyamf.remoting
 
 
 def read_response_payload(payload):
-    return pyamf.remoting.decode(payload)
+    return amf_remoting().decode(payload)
 
 
 def process_envelope(envelope):
     key, response = envelope.bodies[0]
 
-    video_info = response.body
+    return process_video_info(response.body)
+
+
+def process_batch_envelope(envelope, video_ids):
+    '''Split a batched response into a dict of video ID to URL list.
+
+    Videos whose call failed map to an exception instead.
+    '''
+    results = {}
+
+    for key, response in envelope.bodies:
+        index = int(key.strip('/').split('/')[0])
+        video_id = video_ids[index - 1]
+
+        try:
+            if response.status != amf_remoting().STATUS_OK:
+                raise Exception('Gateway error: {0}'.format(response.body))
+
+            results[video_id] = list(process_video_info(response.body))
+        except Exception as error:
+            results[video_id] = error
+
+    for video_id in video_ids:
+        if video_id not in results:
+            results[video_id] = Exception('Missing from gateway response.')
+
+    return results
+
+
+def process_video_info(video_info):
     version = video_info['version']
     if version != 2:
         raise Exception('Unable to handle version {0}.'.format(version))
@@ -100,45 +269,159 @@ def process_envelope(envelope):
         yield url
 
 
+PATH_KEY = b'kluczyk'
+EC_KEY = b'46377904c6c8'
+EC_TOKEN_LIFETIME = 5 * 60
+# Tokens are renewed once less than this many seconds of them are left
+EC_TOKEN_MARGIN = 60
+
+
 def decrypt_path(path):
-    path = path.decode('hex')
-    cipher_key = b'kluczyk'
-    initialization_vector = b'\x00' * 8
-    cipher = Blowfish.new(cipher_key, Blowfish.MODE_CFB, initialization_vector,
-        segment_size=64)
+    return cfb64_decrypt(PATH_KEY, path.decode('hex'))
+
+
+class EdgeCastTokens(object):
+    '''Reuses the token of a host until it is close to expiring.'''
+    def __init__(self, lifetime=EC_TOKEN_LIFETIME, margin=EC_TOKEN_MARGIN):
+        self.lifetime = lifetime
+        self.margin = margin
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, host=None):
+        '''Return ``(token, valid_time)`` for the host.'''
+        now = time.time()
+
+        with self._lock:
+            token, valid_time = self._tokens.get(host, (None, 0))
 
-    padding = b'\x00' * (64 - (len(path) % 64))
-    ciphertext = path + padding
-    plaintext = cipher.decrypt(ciphertext)
-    plaintext = plaintext[:len(path)]
+            if valid_time - now <= self.margin:
+                valid_time = int(now + self.lifetime)
+                token = make_edgecast_token(host, valid_time)
+                self._tokens[host] = (token, valid_time)
 
-    return plaintext
+        return token, valid_time
+
+    def refresh(self, host=None):
+        '''Make a new token for the host, after the CDN refused the old.'''
+        with self._lock:
+            self._tokens.pop(host, None)
+
+        return self.get(host)
+
+    def valid_until(self, urls):
+        '''Time after which the tokens in the URLs should be renewed.'''
+        valid_times = [self.get(urlparse.urlsplit(url).hostname)[1]
+            for url in urls]
+
+        return min(valid_times or [time.time()]) - self.margin
+
+
+EDGECAST_TOKENS = EdgeCastTokens()
 
 
 def get_edgecast_token(host=None):
-    k = b'46377904c6c8'
-    valid_time = int(time.time() + 5 * 60)
+    return EDGECAST_TOKENS.get(host)[0]
+
+
+def make_edgecast_token(host, valid_time):
     s = 'ec_expire=' + str(valid_time)
 
     if host:
         s += '&ec_host_allow=' + host
 
-    return ec_encrypt(k, s)
+    return ec_encrypt(EC_KEY, s)
 
 
 def ec_encrypt(key, text):
     text = text.replace('ec_secure=1', '')
     text = 'ec_secure=' + pad_left(str(len(text) + 14), "0", 3) + '&' + text
 
-    initialization_vector = b'\x00' * 8
-    cipher = Blowfish.new(key, Blowfish.MODE_CFB, initialization_vector,
-        segment_size=64)
+    return cfb64_encrypt(key, text).encode('hex')
+
+
+# Blowfish in CFB mode with 64-bit segments and a zero IV. A CFB cipher
+# object keeps state and can be used for one message only, so CFB is done
+# here on top of a stateless ECB cipher that is set up once per key.
+_ecb_ciphers = {}
+
+
+def get_ecb_cipher(key):
+    cipher = _ecb_ciphers.get(key)
+
+    if not cipher:
+        from Crypto.Cipher import Blowfish
 
-    padding = '\x00' * (64 - (len(text) % 64))
-    plaintext = text + padding
-    ciphertext = cipher.encrypt(plaintext)[:len(text)].encode('hex')
+        cipher = _ecb_ciphers[key] = Blowfish.new(key, Blowfish.MODE_ECB)
 
-    return ciphertext
+    return cipher
+
+
+def cfb64_encrypt(key, plaintext):
+    cipher = get_ecb_cipher(key)
+    previous_block = b'\x00' * 8
+    blocks = []
+
+    for index in range(0, len(plaintext), 8):
+        block = xor_bytes(plaintext[index:index + 8],
+            cipher.encrypt(previous_block))
+        blocks.append(block)
+        previous_block = block.ljust(8, b'\x00')
+
+    return b''.join(blocks)
+
+
+def cfb64_decrypt(key, ciphertext):
+    cipher = get_ecb_cipher(key)
+    padded = ciphertext + b'\x00' * (-len(ciphertext) % 8)
+    keystream = cipher.encrypt(b'\x00' * 8 + padded[:-8])
+
+    return xor_bytes(ciphertext, keystream)
+
+
+def xor_bytes(data, keystream):
+    return b''.join(chr(ord(a) ^ ord(b)) for a, b in zip(data, keystream))
+
+
+class ResolvedCache(object):
+    '''LRU cache of resolved videos.
+
+    Entries expire when the EdgeCast tokens in their URLs are due for
+    renewal.
+    '''
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, video_id):
+        '''Return the cached :class:`Resolved` or None.'''
+        with self._lock:
+            resolved = self._entries.pop(video_id, None)
+
+            if resolved and resolved.expires > time.time():
+                self._entries[video_id] = resolved
+                return resolved
+
+    def put(self, resolved):
+        with self._lock:
+            self._entries.pop(resolved.video_id, None)
+            self._entries[resolved.video_id] = resolved
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class Resolved(object):
+    '''The resolved URLs of a video and the exchange they came from.'''
+    def __init__(self, video_id, urls, exchange=None):
+        self.video_id = video_id
+        self.urls = urls
+        self.exchange = exchange
+        self.expires = EDGECAST_TOKENS.valid_until(urls)
+
+
+RESOLVED_CACHE = ResolvedCache()
 
 
 def pad_left(text, character, length):
@@ -147,112 +430,36 @@ def pad_left(text, character, length):
     return text
 
 
-# Code below taken from seesaw.util
-def test_executable(name, version, path, version_arg="-V"):
-    '''Try to run an executable and check its version.'''
-#     print "Looking for %s in %s" % (name, path)
-    try:
-        process = subprocess.Popen(
-            [path, version_arg],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        stdout_data, stderr_data = process.communicate()
-        result = stdout_data + stderr_data
-        if not process.returncode == 0:
-#             print "%s: Returned code %d" % (path, process.returncode)
-            return False
-
-        if isinstance(version, basestring):
-            if not version in result:
-#                 print "%s: Incorrect %s version (want %s)." % (path, name, version)
-                return False
-        elif hasattr(version, "search"):
-            if not version.search(result):
-#                 print "%s: Incorrect %s version." % (path, name)
-                return False
-        elif hasattr(version, "__iter__"):
-            if not any((v in result) for v in version):
-#                 print "%s: Incorrect %s version (want %s)." % (path, name, str(version))
-                return False
-
-#         print "Found usable %s in %s" % (name, path)
-        return True
-    except OSError as e:
-#         print "%s:" % path, e
-        return False
-
-
-def find_executable(name, version, paths, version_arg="-V"):
-    '''Returns the path of a matching executable.
-
-    .. seealso:: :func:`test_executable`
+def record_exchange(item_dir, exchange, video_urls):
+    '''Write the gateway exchange to the WARC of the item.
+
+    `video_urls` maps the video IDs of the item to their resolved URLs.
     '''
-    for path in paths:
-        if test_executable(name, version, path, version_arg):
-            return path
-    return None
-
-# Code above taken from seesaw.util
-
-WGET_LUA = find_executable(
-    "Wget+Lua",
-    ["GNU Wget 1.14.lua.20130523-9a5c"],
-    [
-        "./wget-lua",
-        "./wget-lua-warrior",
-        "./wget-lua-local",
-        "../wget-lua",
-        "../../wget-lua",
-        "/home/warrior/wget-lua",
-        "/usr/bin/wget-lua"
-    ]
-)
-
-
-def run_wget(video_id, payload, item_dir, decrypted_urls):
-    decrypted_urls_str = json.dumps(decrypted_urls)
-
-    if not WGET_LUA:
-        raise Exception('Wget+Lua not found')
-
-    with tempfile.NamedTemporaryFile() as payload_temp_file:
-        payload_temp_file.write(payload)
-        payload_temp_file.flush()
-
-        wget_args = [
-            WGET_LUA,
-            "-U", USER_AGENT,
-            "-nv",
-            "-o", os.path.join(
-                item_dir, "wget_amf_{0}.log".format(video_id)
-            ),
-            "--no-check-certificate",
-            "--output-document", os.path.join(
-                item_dir, "wget_amf_{0}.tmp".format(video_id)
-            ),
-            "--truncate-output",
-            "-e", "robots=off",
-            "--no-cookies",
-            "--rotate-dns",
-            "--timeout", "60",
-            "--tries", "10",
-            "--waitretry", "3600",
-            "--warc-file", os.path.join(
-                item_dir, "viddler_amf.{0}.{1}".format(video_id, int(time.time()))
-            ),
-            "--warc-header", "operator: Archive Team",
-            "--warc-header", "viddler-riddler-dld-script-version: " + VERSION,
-            "--warc-header", "viddler-video-id: {0}".format(video_id),
-            "--warc-header", "viddler-video-resolved-urls-json: {0}".format(
-                decrypted_urls_str),
-            '--method', 'POST',
-            '--body-file', payload_temp_file.name,
-            '--header', 'Content-Type: application/x-amf',
-            'http://www.viddler.com/amfgateway.action'
-        ]
-
-        subprocess.call(wget_args)
+    metadata = warcwriter.warc_fields([
+        ('operator', 'Archive Team'),
+        ('viddler-riddler-dld-script-version', VERSION),
+        ('viddler-video-ids', ','.join(sorted(video_urls))),
+        ('viddler-video-resolved-urls-json',
+            json.dumps(video_urls, sort_keys=True)),
+    ])
+    ip_headers = []
+
+    if exchange.ip_address:
+        ip_headers.append(('WARC-IP-Address', exchange.ip_address))
+
+    with checkpoint.Checkpoint(item_dir).appending(
+            checkpoint.AMF_SEGMENT) as out_file:
+        writer = warcwriter.WarcWriter(out_file)
+        response_id = writer.write_record('response', exchange.response,
+            warcwriter.HTTP_RESPONSE_TYPE, exchange.url, exchange.date,
+            headers=ip_headers)
+        writer.write_record('request', exchange.request,
+            warcwriter.HTTP_REQUEST_TYPE, exchange.url, exchange.date,
+            headers=ip_headers + [('WARC-Concurrent-To', response_id)])
+        writer.write_record('metadata', metadata,
+            warcwriter.WARC_FIELDS_TYPE, exchange.url, exchange.date,
+            headers=[('WARC-Concurrent-To', response_id)])
+
 
 if __name__ == '__main__':
     main()
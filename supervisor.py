@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+'''Run several pipeline processes on one machine as a team.
+
+One run-pipeline process is limited by a single Python interpreter. This
+script starts a number of them on pipeline.py and lets them share what
+they would otherwise each do on their own:
+
+* the startup checks, which are run once here before the workers start
+  so that they find them in the discovery cache (see discovery.py),
+* the tracker, which the workers reach through one connection kept by
+  this script. When the tracker has no items or limits the rate, all
+  workers back off together instead of each asking on its own.
+* the staging space, counted across the workers (see StagingQueue),
+* an optional bandwidth budget (see pacing.SharedByteRate), and
+* the metrics, which are combined on one port.
+
+Example::
+
+    ./supervisor.py --workers 4 --concurrent 2 YOURNICKHERE
+
+Options after ``--`` go to every run-pipeline. Worker N serves its web
+interface on port ``--port`` + N. A worker that crashes is started again.
+'''
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import httplib
+import json
+import os
+import signal
+import socket
+import SocketServer
+import subprocess
+import sys
+import threading
+import time
+
+import metrics
+
+
+TRACKER_HOST = 'tracker.archiveteam.org'
+RESTART_DELAY = 60
+
+LOAD_PIPELINE = '''
+import sys
+context = {'downloader': sys.argv[1], '__name__': 'pipeline'}
+execfile('pipeline.py', context)
+'''
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('downloader')
+    arg_parser.add_argument('--workers', type=int, default=2)
+    arg_parser.add_argument('--concurrent', type=int, default=2,
+        help='items per worker')
+    arg_parser.add_argument('--port', type=int, default=8001,
+        help='web interface port of the first worker')
+    arg_parser.add_argument('--metrics-port', type=int,
+        help='serve the combined metrics of the workers on this port')
+    arg_parser.add_argument('--limit-rate', type=int,
+        help='KiB/s for all workers together')
+    arg_parser.add_argument('--tracker', default=TRACKER_HOST)
+    arg_parser.add_argument('--run-pipeline', default='run-pipeline')
+    arg_parser.add_argument('pipeline_args', nargs=argparse.REMAINDER)
+    args = arg_parser.parse_args()
+
+    pipeline_args = args.pipeline_args
+
+    if pipeline_args and pipeline_args[0] == '--':
+        pipeline_args = pipeline_args[1:]
+
+    # Fails once, with the reason, if Wget+Lua or a module is missing
+    exit_code = subprocess.call([sys.executable, '-c', LOAD_PIPELINE,
+        args.downloader])
+
+    if exit_code:
+        sys.exit(exit_code)
+
+    proxy = TrackerProxy(args.tracker)
+    proxy.start()
+
+    context_values = {
+        'tracker_proxy': '127.0.0.1:{0}'.format(proxy.port),
+        'staging_ledger': os.path.join(os.getcwd(), '.staging'),
+    }
+
+    if args.limit_rate:
+        context_values['bandwidth_limit'] = str(args.limit_rate)
+        context_values['bandwidth_file'] = os.path.join(os.getcwd(),
+            '.bandwidth')
+
+    workers = []
+
+    for index in range(args.workers):
+        worker_values = dict(context_values, worker_id=str(index))
+
+        if args.metrics_port:
+            worker_values['metrics_port'] = str(args.metrics_port + 1 + index)
+
+        command = [args.run_pipeline, 'pipeline.py', args.downloader,
+            '--concurrent', str(args.concurrent),
+            '--port', str(args.port + index)]
+
+        for name, value in sorted(worker_values.items()):
+            command.extend(['--context-value', '{0}={1}'.format(name, value)])
+
+        workers.append(Worker(index, command + pipeline_args))
+
+    if args.metrics_port:
+        metrics.serve_metrics(CombinedMetrics(
+            [args.metrics_port + 1 + index for index in range(args.workers)]),
+            args.metrics_port)
+
+    def terminate(signum, frame):
+        for worker in workers:
+            worker.stop()
+
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    for worker in workers:
+        worker.start()
+
+    while any(worker.running for worker in workers):
+        time.sleep(1)
+
+        for worker in workers:
+            worker.check()
+
+
+class Worker(object):
+    def __init__(self, index, command):
+        self.index = index
+        self.command = command
+        self.process = None
+        self.running = False
+        self._restart_time = None
+
+    def start(self):
+        print('Starting worker {0}: {1}'.format(self.index,
+            ' '.join(self.command)))
+        self.process = subprocess.Popen(self.command)
+        self.running = True
+        self._restart_time = None
+
+    def stop(self):
+        self.running = False
+
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+    def check(self):
+        if not self.running:
+            return
+
+        if self._restart_time:
+            if time.time() >= self._restart_time:
+                self.start()
+            return
+
+        exit_code = self.process.poll()
+
+        if exit_code is None:
+            return
+
+        if exit_code == 0:
+            # Stopped on purpose, e.g. with a stop file
+            print('Worker {0} has stopped.'.format(self.index))
+            self.running = False
+        else:
+            print('Worker {0} exited with {1}; starting it again in {2} '
+                'seconds.'.format(self.index, exit_code, RESTART_DELAY))
+            self._restart_time = time.time() + RESTART_DELAY
+
+
+class TrackerProxy(object):
+    '''Passes the workers' tracker requests on over one connection.
+
+    Item requests that the tracker refuses with 404 (no items) or 420 or
+    429 (rate limit) put every worker on hold: until the backoff is over,
+    further item requests get the same answer without reaching the
+    tracker. The backoff doubles up to `max_backoff` while the tracker
+    keeps refusing.
+    '''
+    REFUSALS = (404, 420, 429)
+
+    def __init__(self, host, timeout=60, min_backoff=5, max_backoff=300):
+        self.host = host
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.port = None
+        self._connection = None
+        self._lock = threading.Lock()
+        self._backoff = 0
+        self._backoff_until = 0
+        self._refusal = None
+
+    def start(self):
+        proxy = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.forward()
+
+            def do_POST(self):
+                self.forward()
+
+            def forward(self):
+                length = int(self.headers.get('content-length', 0))
+                body = self.rfile.read(length) if length else None
+                status, content_type, response_body = proxy.request(
+                    self.command, self.path, body,
+                    self.headers.get('content-type'))
+
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(response_body)))
+                self.end_headers()
+                self.wfile.write(response_body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        server = Server(('127.0.0.1', 0), Handler)
+        self.port = server.server_address[1]
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def request(self, method, path, body=None, content_type=None):
+        '''Return the status, content type and body of the answer.'''
+        is_item_request = path.rstrip('/').endswith('/request')
+
+        with self._lock:
+            if is_item_request and time.time() < self._backoff_until:
+                return self._refusal
+
+            answer = self._send(method, path, body, content_type)
+
+            if is_item_request:
+                if answer[0] in self.REFUSALS:
+                    self._backoff = min(self.max_backoff,
+                        max(self.min_backoff, self._backoff * 2))
+                    self._backoff_until = time.time() + self._backoff
+                    self._refusal = answer
+                elif answer[0] == 200:
+                    self._backoff = 0
+
+            return answer
+
+    def _send(self, method, path, body, content_type):
+        headers = {}
+
+        if content_type:
+            headers['Content-Type'] = content_type
+
+        # The tracker may have closed the kept-alive connection
+        for attempt in range(2):
+            if not self._connection:
+                self._connection = httplib.HTTPConnection(self.host,
+                    timeout=self.timeout)
+
+            try:
+                self._connection.request(method, path, body, headers)
+                response = self._connection.getresponse()
+                answer = (response.status,
+                    response.getheader('content-type', 'text/plain'),
+                    response.read())
+            except (httplib.HTTPException, socket.error) as error:
+                self._connection.close()
+                self._connection = None
+
+                if attempt:
+                    return (502, 'text/plain', str(error))
+            else:
+                if response.will_close:
+                    self._connection.close()
+                    self._connection = None
+
+                return answer
+
+
+class CombinedMetrics(object):
+    '''The metrics of all workers, for metrics.serve_metrics.'''
+    def __init__(self, ports):
+        self.ports = ports
+
+    def to_dict(self):
+        worker_metrics = []
+
+        for port in self.ports:
+            try:
+                connection = httplib.HTTPConnection('127.0.0.1', port,
+                    timeout=5)
+                connection.request('GET', '/')
+                worker_metrics.append(json.loads(
+                    connection.getresponse().read()))
+                connection.close()
+            except (httplib.HTTPException, socket.error, ValueError):
+                # Starting up or restarting
+                continue
+
+        return metrics.combine(worker_metrics)
+
+
+if __name__ == '__main__':
+    main()
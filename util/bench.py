@@ -0,0 +1,239 @@
+'''Benchmark the download of items against a local fake Viddler.
+
+Runs the pipeline's own tasks (PrepareDirectories, ProbeIDs, the resolver
+pool, wget-lua with viddler.lua, FetchVideos, CompressSegments,
+MoveFiles) for a few items, with all traffic going to
+util/fake_viddler.py. Prints the wall and CPU time of each stage, and
+the IDs and bytes per second, as JSON.
+
+Example::
+
+    python util/bench.py --items 2 --size 2000 --hit-ratio 0.01 \\
+        --video-size 4194304 --video-latency 0.05
+
+Needs seesaw, pyamf, pycrypto and a wget-lua like a real run does.
+'''
+from __future__ import print_function
+
+import argparse
+import httplib
+import itertools
+import json
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from fake_viddler import FakeViddler
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--items', type=int, default=1)
+    arg_parser.add_argument('--start', type=int, default=0)
+    arg_parser.add_argument('--size', type=int, default=2000,
+        help='IDs per item')
+    arg_parser.add_argument('--hit-ratio', type=float, default=0.01)
+    arg_parser.add_argument('--video-size', type=int, default=1048576)
+    arg_parser.add_argument('--video-latency', type=float, default=0.0)
+    arg_parser.add_argument('--shards', type=int, default=1)
+    arg_parser.add_argument('--probe-concurrency', type=int, default=8)
+    arg_parser.add_argument('--compression-threads', type=int, default=0,
+        help='compress the WARCs after wget in this many threads')
+    arg_parser.add_argument('--compression-level', type=int, default=6)
+    arg_parser.add_argument('--data-dir',
+        help='keep the output here instead of a temporary directory')
+    args = arg_parser.parse_args()
+
+    server = FakeViddler(hit_ratio=args.hit_ratio,
+        video_size=args.video_size, video_latency=args.video_latency)
+    server.start()
+    redirect_connections(server.port)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='viddler-bench-')
+    bench = Bench(load_pipeline(), server, data_dir, args.shards,
+        args.probe_concurrency, args.compression_threads,
+        args.compression_level)
+    reports = []
+    start_time = time.time()
+
+    try:
+        for index in range(args.items):
+            start = args.start + index * args.size
+            reports.append(bench.run_item(start, start + args.size - 1))
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir)
+
+    seconds = time.time() - start_time
+    ids = args.items * args.size
+    output_bytes = sum(report['output_bytes'] for report in reports)
+
+    print(json.dumps({
+        'items': reports,
+        'seconds': seconds,
+        'ids_per_second': ids / seconds,
+        'output_bytes_per_second': output_bytes / seconds,
+        'served_bytes_per_second': server.counters['bytes_sent'] / seconds,
+        'server': dict(server.counters),
+    }, indent=2, sort_keys=True))
+
+
+def redirect_connections(port):
+    '''Send the pipeline's own HTTP connections to the fake server.'''
+    original_class = httplib.HTTPConnection
+
+    class RedirectedConnection(original_class):
+        def __init__(self, host, *args, **kwargs):
+            original_class.__init__(self, '127.0.0.1', port, *args, **kwargs)
+
+    httplib.HTTPConnection = RedirectedConnection
+
+
+def load_pipeline():
+    '''Load pipeline.py the way run-pipeline does.'''
+    os.chdir(REPO_DIR)
+    context = {'downloader': 'bench', '__name__': 'pipeline'}
+    execfile(os.path.join(REPO_DIR, 'pipeline.py'), context)
+
+    return context
+
+
+class BenchItem(dict):
+    '''Just enough of seesaw's Item for the tasks to run.'''
+    _ids = itertools.count(1)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.item_id = next(self._ids)
+
+    def log_output(self, data):
+        pass
+
+    def description(self):
+        return 'Item %s' % self['item_name']
+
+
+class Bench(object):
+    def __init__(self, context, server, data_dir, shards, probe_concurrency,
+            compression_threads=0, compression_level=6):
+        self.context = context
+        self.server = server
+        self.data_dir = data_dir
+
+        # Each run starts from scratch instead of resuming or deduplicating
+        # against the last one
+        context['CHECKPOINT_DIR'] = os.path.join(data_dir, 'checkpoints')
+        context['DEDUP_INDEX_FILENAME'] = os.path.join(data_dir, 'dedup.cdx')
+        self.prepare = context['PrepareDirectories'](warc_prefix='bench',
+            shard_count=shards)
+        self.probe = context['ProbeIDs'](concurrency=probe_concurrency)
+        self.salvage = context['SalvageSegments']()
+        self.salvage_wget = context['SalvageSegments']('SalvageWgetSegments',
+            wget_only=True)
+        self.start_resolver = context['StartResolver'](
+            context['RESOLVER_POOL'], context['HOST_PACER'],
+            video_connections=4)
+        self.stop_resolver = context['StopResolver']()
+        self.fetch_videos = context['FetchVideos'](connections=4)
+        self.compress_segments = context['CompressSegments'](
+            compression_threads, compression_level)
+        self.merge_segments = context['MergeSegments']()
+        self.update_dedup_index = context['UpdateDedupIndex'](
+            context['DEDUP_INDEX'])
+        self.move_files = context['MoveFiles']()
+        self.wget_args = context['WgetArgs'](
+            accept_on_exit_code=context['WGET_ACCEPT_ON_EXIT_CODE'],
+            compression_threads=compression_threads)
+
+    def run_item(self, start, end):
+        item = BenchItem(item_name='%d:%d' % (start, end),
+            data_dir=self.data_dir)
+        stages = []
+
+        def stage(name, function):
+            def run(item):
+                # Threaded tasks return the properties to set on the item
+                item.update(function(item) or {})
+
+            stages.append(measure(name, run, item))
+
+        stage('PrepareDirectories', self.prepare.process)
+        stage('ProbeIDs', self.probe.process)
+        stage('SalvageSegments', self.salvage.process)
+        stage('StartResolver', self.start_resolver.process)
+        stage('WgetDownload', self.run_wget)
+        stage('SalvageWgetSegments', self.salvage_wget.process)
+        stage('StopResolver', self.stop_resolver.process)
+        stage('FetchVideos', self.fetch_videos.process)
+        stage('CompressSegments', self.compress_segments.process)
+        stage('MergeSegments', self.merge_segments.process)
+        stage('UpdateDedupIndex', self.update_dedup_index.process)
+        stage('MoveFiles', self.move_files.process)
+
+        seconds = sum(report['seconds'] for report in stages)
+
+        return {
+            'item': item['item_name'],
+            'stages': stages,
+            'seconds': seconds,
+            'ids_per_second': (end - start + 1) / seconds,
+            'output_bytes': sum(info['size']
+                for info in item['file_info'].itervalues()),
+        }
+
+    def run_wget(self, item):
+        # Realizing the arguments picks the WARC segment for the run
+        args = self.wget_args.realize(item)
+        env = dict(os.environ)
+        env.update({
+            'item_name': item['item_name'],
+            'item_dir': item['item_dir'],
+            'resolver_in': item['resolver_in'],
+            'resolver_out': item['resolver_out'],
+            'warc_segment': item['warc_segment'],
+            'http_proxy': 'http://127.0.0.1:%d/' % self.server.port,
+        })
+
+        with open(os.devnull, 'w') as null_file:
+            exit_code = subprocess.call(args, env=env, stdout=null_file)
+
+        if exit_code not in self.context['WGET_ACCEPT_ON_EXIT_CODE']:
+            raise Exception('Wget exited with %d.' % exit_code)
+
+
+def measure(name, function, item):
+    '''Run function(item) and return its wall and CPU times.
+
+    Child CPU time covers wget-lua and anything it starts.
+    '''
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_time = time.time()
+
+    function(item)
+
+    seconds = time.time() - start_time
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        'stage': name,
+        'seconds': seconds,
+        'cpu_seconds': cpu_time(self_after) - cpu_time(self_before),
+        'child_cpu_seconds':
+            cpu_time(children_after) - cpu_time(children_before),
+    }
+
+
+def cpu_time(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+'''A local stand-in for the Viddler site, for benchmarks.
+
+The server answers as an HTTP proxy, so wget can be pointed at it with
+``http_proxy``, and also to plain requests. It serves:
+
+* ``/v/<hex>``: a video page for a fraction `hit_ratio` of the IDs and
+  404 for the rest,
+* ``/embed/<hex>/``: the embed page,
+* ``/amfgateway.action``: getVideoInfo answers with encrypted paths, and
+* the video files on the CDN host, of `video_size` bytes after
+  `video_latency` seconds.
+
+Run it on its own with ``python util/fake_viddler.py --port 8080``.
+'''
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import collections
+import os
+import re
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+
+import pyamf.remoting
+
+import riddler
+
+
+CDN_HOST = 'cdn-ec.viddler.com'
+
+
+class FakeViddler(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), hit_ratio=0.01,
+            video_size=1048576, video_latency=0.0, files_per_video=1):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeViddlerHandler)
+        self.hit_ratio = hit_ratio
+        self.video_size = video_size
+        self.video_latency = video_latency
+        self.files_per_video = files_per_video
+        self.counters = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def is_hit(self, video_id):
+        # Knuth's multiplicative hash spreads hits over the range
+        return (video_id * 2654435761 % 2 ** 32) < self.hit_ratio * 2 ** 32
+
+    def video_paths(self, video_id):
+        return ['http://{0}/files/{1:x}-{2}.flv'.format(CDN_HOST, video_id,
+            index) for index in range(self.files_per_video)]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class FakeViddlerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self, head=False):
+        url_info = urlparse.urlsplit(self.path)
+        host = url_info.netloc or self.headers.get('host', '')
+        path = url_info.path
+
+        if host.split(':')[0] == CDN_HOST:
+            self.serve_video(path, head)
+            return
+
+        match = re.match(r'/v/([0-9a-f]+)$', path)
+
+        if match:
+            self.serve_video_page(int(match.group(1), 16), head)
+        elif re.match(r'/embed/[0-9a-f]+/?$', path):
+            self.send_body(200, 'text/html',
+                '<html><body>embed</body></html>', head)
+        elif path == '/amfgateway.action':
+            self.serve_gateway()
+        elif re.match(r'/file/[0-9a-f]+/html5$', path):
+            self.send_body(200, 'text/html', '<html></html>', head)
+        else:
+            self.send_body(404, 'text/html', 'Not found', head)
+
+    def serve_video_page(self, video_id, head):
+        if not self.server.is_hit(video_id):
+            self.server.count('video_page_misses')
+            self.send_body(404, 'text/html', 'Not found', head)
+            return
+
+        self.server.count('video_page_hits')
+        self.send_body(200, 'text/html',
+            '<html><body><embed src="http://www.viddler.com/embed/{0:x}/">'
+            '</body></html>'.format(video_id), head)
+
+    def serve_gateway(self):
+        length = int(self.headers.get('content-length', 0))
+        request_envelope = pyamf.remoting.decode(self.rfile.read(length))
+        response_envelope = pyamf.remoting.Envelope(amfVersion=0)
+
+        for key, request in request_envelope.bodies:
+            video_id = int(request.body[0], 16)
+            files = [{'path': riddler.cfb64_encrypt(riddler.PATH_KEY, path)
+                .encode('hex')} for path in self.server.video_paths(video_id)]
+            response_envelope[key] = pyamf.remoting.Response(
+                {'version': 2, 'files': files})
+            self.server.count('gateway_calls')
+
+        self.server.count('gateway_requests')
+        self.send_body(200, 'application/x-amf',
+            pyamf.remoting.encode(response_envelope).getvalue())
+
+    def serve_video(self, path, head):
+        time.sleep(self.server.video_latency)
+        self.server.count('videos')
+
+        size = self.server.video_size
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('range', ''))
+
+        if match and int(match.group(1)) < size:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                'bytes {0}-{1}/{2}'.format(start, end, size))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'video/x-flv')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        if head:
+            return
+
+        chunk = b'\x00' * 65536
+        remaining = end - start + 1
+
+        while remaining > 0:
+            data = chunk[:remaining]
+            self.wfile.write(data)
+            remaining -= len(data)
+
+        self.server.count('bytes_sent', end - start + 1)
+
+    def send_body(self, status, content_type, body, head=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if not head:
+            self.wfile.write(body)
+            self.server.count('bytes_sent', len(body))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--port', type=int, default=8080)
+    arg_parser.add_argument('--hit-ratio', type=float, default=0.01)
+    arg_parser.add_argument('--video-size', type=int, default=1048576)
+    arg_parser.add_argument('--video-latency', type=float, default=0.0)
+    args = arg_parser.parse_args()
+
+    server = FakeViddler(('127.0.0.1', args.port), hit_ratio=args.hit_ratio,
+        video_size=args.video_size, video_latency=args.video_latency)
+    print('Serving on port', server.port, file=sys.stderr)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,230 @@
-'''This script samples videos IDs to find the percentage of 200 OK and
-404 Not found'''
+'''This script samples videos IDs to estimate how many of them exist.
+
+The ID range is split into blocks and the same number of random IDs is
+probed in each block, so the output is a map of hit density per block.
+Probes run concurrently under a request rate limit. Every final answer
+is appended to a checkpoint file, and a restarted run skips the IDs that
+are already in it. Answers that are not final to the pipeline either
+(see probe.is_final), like failed requests, 429 and 5xx, are probed
+again by the next run.
+
+Example::
+
+    python util/id_sampler.py --samples-per-block 4 --rate 10 \\
+        --checkpoint sampler.checkpoint --output density.json
+
+Point ``--url`` at a local server to try it without hitting the site.
+'''
 from __future__ import print_function
+
+import argparse
+import json
+import os
+import Queue
 import random
-import urllib2
+import sys
+import threading
+import time
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+
+import probe
+
+
+URL = probe.VIDEO_URL
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--start', type=int, default=0)
+    arg_parser.add_argument('--end', type=int, default=2 ** 32 - 1)
+    arg_parser.add_argument('--block-size', type=int, default=2 ** 24)
+    arg_parser.add_argument('--samples-per-block', type=int, default=4)
+    arg_parser.add_argument('--concurrency', type=int, default=8)
+    arg_parser.add_argument('--rate', type=float, default=10,
+        help='maximum requests per second, 0 for no limit')
+    arg_parser.add_argument('--seed', type=int, default=12345)
+    arg_parser.add_argument('--url', default=URL)
+    arg_parser.add_argument('--checkpoint', default='id_sampler.checkpoint')
+    arg_parser.add_argument('--output', help='density map file; '
+        'printed if not given')
+    args = arg_parser.parse_args()
+
+    blocks = list(make_blocks(args.start, args.end, args.block_size))
+    samples = list(stratified_sample(blocks, args.samples_per_block,
+        args.seed))
+    results = read_checkpoint(args.checkpoint)
+    pending = [video_id for video_id in samples if video_id not in results]
+
+    print('Probing', len(pending), 'of', len(samples), 'IDs..',
+        file=sys.stderr)
+
+    sampler = Sampler(args.url, concurrency=args.concurrency, rate=args.rate)
+
+    with open(args.checkpoint, 'a') as checkpoint_file:
+        for video_id, status in sampler.run(pending):
+            if not probe.is_final(status):
+                # Left out of the checkpoint so it is probed again on resume
+                print('ID=', '{0:x}'.format(video_id), 'failed', status,
+                    file=sys.stderr)
+                continue
+
+            results[video_id] = status
+            checkpoint_file.write('{0} {1}\n'.format(video_id, status))
+            checkpoint_file.flush()
+
+    density_map = make_density_map(blocks, samples, results)
+    doc = json.dumps(density_map, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            out_file.write(doc)
+    else:
+        print(doc)
+
+
+def make_blocks(start, end, block_size):
+    for block_start in xrange(start, end + 1, block_size):
+        yield block_start, min(block_start + block_size - 1, end)
+
+
+def stratified_sample(blocks, samples_per_block, seed):
+    '''Pick the same number of random IDs from every block.
+
+    The pick only depends on the arguments, so a resumed run samples the
+    same IDs as the original one.
+    '''
+    rand = random.Random(seed)
+
+    for block_start, block_end in blocks:
+        count = min(samples_per_block, block_end - block_start + 1)
+
+        for video_id in sorted(rand.sample(
+                xrange(block_start, block_end + 1), count)):
+            yield video_id
+
 
-URL = 'http://www.viddler.com/v/{0:x}'
+def read_checkpoint(filename):
+    results = {}
 
+    if not os.path.exists(filename):
+        return results
 
-def main(start=0, end=2 ** 32 - 1):
-    random.seed(12345)
+    with open(filename) as in_file:
+        for line in in_file:
+            parts = line.split()
 
-    ok = 0
-    bad = 0
+            # A torn last line from an interrupted run is ignored, and
+            # errors that older versions kept are probed again
+            if len(parts) == 2 and probe.is_final(int(parts[1])):
+                results[int(parts[0])] = int(parts[1])
 
-    for video_id in random.sample(xrange(start, end + 1), 1000):
-        try:
-            url = URL.format(video_id)
-            urllib2.urlopen(url)
-        except urllib2.URLError as error:
-            print(error)
-            bad += 1
+    return results
+
+
+def is_hit(status):
+    return 200 <= status < 400
+
+
+def make_density_map(blocks, samples, results):
+    block_size = blocks[0][1] - blocks[0][0] + 1 if blocks else 0
+    stats = dict((block, {'samples': 0, 'hits': 0}) for block in blocks)
+    block_starts = [block_start for block_start, block_end in blocks]
+    index = 0
+
+    for video_id in samples:
+        if video_id not in results:
+            continue
+
+        while index + 1 < len(blocks) and video_id >= block_starts[index + 1]:
+            index += 1
+
+        block_stats = stats[blocks[index]]
+        block_stats['samples'] += 1
+
+        if is_hit(results[video_id]):
+            block_stats['hits'] += 1
+
+    block_docs = []
+
+    for block_start, block_end in blocks:
+        block_stats = stats[(block_start, block_end)]
+
+        if block_stats['samples']:
+            density = float(block_stats['hits']) / block_stats['samples']
         else:
-            ok += 1
+            density = None
+
+        block_docs.append({
+            'start': block_start,
+            'end': block_end,
+            'samples': block_stats['samples'],
+            'hits': block_stats['hits'],
+            'density': density,
+        })
+
+    total_samples = sum(block['samples'] for block in block_docs)
+    total_hits = sum(block['hits'] for block in block_docs)
+
+    return {
+        'block_size': block_size,
+        'samples': total_samples,
+        'hits': total_hits,
+        'density': float(total_hits) / total_samples if total_samples else None,
+        'blocks': block_docs,
+    }
+
+
+class RateLimiter(object):
+    '''Spaces out calls to wait() to at most `rate` per second.'''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next_time = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.time()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class Sampler(object):
+    '''Probes IDs the way the pipeline does (see probe.py), under a
+    request rate limit.'''
+    def __init__(self, url=URL, concurrency=8, rate=10, timeout=60):
+        url_info = urlparse.urlsplit(url)
+        host = url_info.netloc
+        self.prober = probe.Prober(concurrency=concurrency, timeout=timeout,
+            host=host, path=url[url.index(host) + len(host):],
+            throttle=RateLimiter(rate).wait)
+
+    def run(self, video_ids):
+        '''Yield ``(video_id, status)`` as the answers come in.
+
+        The status is None if the request failed.
+        '''
+        video_ids = list(video_ids)
+        out_queue = Queue.Queue()
+        thread = threading.Thread(target=self.prober.probe,
+            args=(video_ids, lambda video_id, status:
+                out_queue.put((video_id, status))))
+        thread.daemon = True
+        thread.start()
+
+        for dummy in range(len(video_ids)):
+            yield out_queue.get()
+
+        thread.join()
 
-        ratio = float(ok) / bad
-        print('ID=', video_id, '{0:x}'.format(video_id), 'OK=', ok, 'Bad=', bad, 'Ratio=', ratio)
 
 if __name__ == '__main__':
     main()
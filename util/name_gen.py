@@ -1,13 +1,275 @@
+'''Generate item names (``start:end`` ID ranges) for the tracker.
+
+Without options this prints fixed ranges of 2000 IDs over the 32-bit ID
+space. Given a density map from id_sampler.py (``--density``) or hit
+counts of finished items (``--hits``, lines of ``start:end hits``), ranges
+are sized so that each item has about the same expected work: a live
+video costs ``--hit-cost`` units and a missing one ``--miss-cost``.
+
+``--plan`` reads the items the tracker has not handed out yet, one
+``start:end`` per line, and prints how to split or merge them instead::
+
+    split 0:1999 -> 0:999 1000:1999
+    merge 2000:3999 4000:5999 -> 2000:5999
+
+Output is streamed, so the whole ID space never has to fit in memory.
+'''
 from __future__ import print_function
 
+import argparse
+import bisect
+import json
+import math
+
 
 def main():
-    start = 0
-    end = 2 ** 32 - 1
-    size = 2000
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--start', type=int, default=0)
+    arg_parser.add_argument('--end', type=int, default=2 ** 32 - 1)
+    arg_parser.add_argument('--size', type=int, default=2000,
+        help='IDs per item without density information, and the size '
+        'of an average item otherwise')
+    source_group = arg_parser.add_mutually_exclusive_group()
+    source_group.add_argument('--density',
+        help='density map written by id_sampler.py')
+    source_group.add_argument('--hits',
+        help='file of "start:end hits" lines from finished items')
+    arg_parser.add_argument('--hit-cost', type=float, default=100)
+    arg_parser.add_argument('--miss-cost', type=float, default=1)
+    arg_parser.add_argument('--target-work', type=float,
+        help='expected work per item; defaults to that of an average item '
+        'of --size IDs')
+    arg_parser.add_argument('--min-size', type=int, default=1)
+    arg_parser.add_argument('--max-size', type=int, default=2 ** 20)
+    arg_parser.add_argument('--plan',
+        help='file of item names not handed out yet')
+    args = arg_parser.parse_args()
+
+    if args.density:
+        density_map = read_density_map(args.density)
+    elif args.hits:
+        density_map = read_hit_counts(args.hits)
+    else:
+        density_map = None
+
+    if density_map:
+        cost = CostModel(args.hit_cost, args.miss_cost)
+        target_work = args.target_work or \
+            args.size * cost(density_map.default_density)
+        min_size = args.min_size
+        max_size = args.max_size
+    else:
+        # Every ID costs the same, giving fixed size ranges
+        density_map = DensityMap([], 0)
+        cost = CostModel(0, 1)
+        target_work = args.target_work or args.size
+        min_size = max_size = int(target_work)
+
+    generator = ItemGenerator(density_map, cost, target_work, min_size,
+        max_size)
+
+    if args.plan:
+        with open(args.plan) as in_file:
+            for action, old_ranges, new_ranges in generator.plan(
+                    read_item_names(in_file)):
+                print(action, ' '.join(format_range(r) for r in old_ranges),
+                    '->', ' '.join(format_range(r) for r in new_ranges))
+    else:
+        for item_range in generator.ranges(args.start, args.end):
+            print(format_range(item_range))
+
+
+def format_range(item_range):
+    return '{0}:{1}'.format(*item_range)
+
+
+def parse_range(item_name):
+    start, end = item_name.split(':', 1)
+    return int(start), int(end)
+
+
+def read_item_names(in_file):
+    for line in in_file:
+        line = line.strip()
+
+        if line:
+            yield parse_range(line)
+
+
+def read_density_map(filename):
+    with open(filename) as in_file:
+        doc = json.load(in_file)
+
+    segments = [(block['start'], block['end'], block['density'])
+        for block in doc['blocks'] if block['density'] is not None]
+
+    return DensityMap(segments, doc['density'] or 0)
+
+
+def read_hit_counts(filename):
+    segments = []
+    total_size = 0
+    total_hits = 0
+
+    with open(filename) as in_file:
+        for line in in_file:
+            parts = line.split()
+
+            if len(parts) != 2:
+                continue
+
+            start, end = parse_range(parts[0])
+            hits = int(parts[1])
+            size = end - start + 1
+            segments.append((start, end, float(hits) / size))
+            total_size += size
+            total_hits += hits
+
+    if total_size:
+        default_density = float(total_hits) / total_size
+    else:
+        default_density = 0
+
+    return DensityMap(segments, default_density)
+
+
+class CostModel(object):
+    '''Expected work of one ID at a given hit density.'''
+    def __init__(self, hit_cost, miss_cost):
+        self.hit_cost = hit_cost
+        self.miss_cost = miss_cost
+
+    def __call__(self, density):
+        return self.hit_cost * density + self.miss_cost * (1 - density)
+
+
+class DensityMap(object):
+    '''Hit density over ID ranges.
+
+    `segments` is a list of non-overlapping ``(start, end, density)``.
+    IDs outside of them get `default_density`.
+    '''
+    def __init__(self, segments, default_density):
+        self.segments = sorted(segments)
+        self.default_density = default_density
+        self._starts = [segment[0] for segment in self.segments]
+
+    def runs(self, start, end):
+        '''Yield ``(start, end, density)`` runs that cover the range.'''
+        index = max(0, bisect.bisect_right(self._starts, start) - 1)
+        position = start
+
+        while position <= end:
+            if index < len(self.segments):
+                seg_start, seg_end, density = self.segments[index]
+            else:
+                seg_start = seg_end = end + 1
+                density = None
+
+            if seg_end < position:
+                index += 1
+            elif seg_start > position:
+                run_end = min(seg_start - 1, end)
+                yield position, run_end, self.default_density
+                position = run_end + 1
+            else:
+                run_end = min(seg_end, end)
+                yield position, run_end, density
+                position = run_end + 1
+                index += 1
+
+    def work(self, start, end, cost):
+        return sum((run_end - run_start + 1) * cost(density)
+            for run_start, run_end, density in self.runs(start, end))
+
+
+class ItemGenerator(object):
+    def __init__(self, density_map, cost, target_work, min_size, max_size):
+        self.density_map = density_map
+        self.cost = cost
+        self.target_work = target_work
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def ranges(self, start, end):
+        '''Yield ``(start, end)`` items of about `target_work` each.'''
+        item_start = start
+        work = 0.0
+
+        for run_start, run_end, density in self.density_map.runs(start, end):
+            id_cost = self.cost(density)
+            position = run_start
+
+            while position <= run_end:
+                item_size = position - item_start
+
+                if id_cost:
+                    count = int(math.ceil((self.target_work - work) / id_cost))
+                else:
+                    count = self.max_size
+
+                count = max(count, self.min_size - item_size, 1)
+                count = min(count, self.max_size - item_size,
+                    run_end - position + 1)
+
+                work += count * id_cost
+                position += count
+                item_size += count
+
+                if item_size >= self.max_size or (
+                        work >= self.target_work and
+                        item_size >= self.min_size):
+                    yield item_start, position - 1
+                    item_start = position
+                    work = 0.0
+
+        if item_start <= end:
+            yield item_start, end
+
+    def plan(self, item_ranges):
+        '''Yield ``(action, old ranges, new ranges)`` for pending items.
+
+        Items with much more than the target work are split, and runs of
+        adjacent items with little work are merged. Items that are fine
+        as they are are left out.
+        '''
+        group = []
+        group_work = 0.0
+
+        for item_range in item_ranges:
+            start, end = item_range
+            work = self.density_map.work(start, end, self.cost)
+
+            if work > 2 * self.target_work:
+                for change in self._flush(group):
+                    yield change
+
+                group = []
+                group_work = 0.0
+
+                yield 'split', [item_range], list(self.ranges(start, end))
+                continue
+
+            contiguous = group and group[-1][1] + 1 == start
+            size = end - group[0][0] + 1 if group else 0
+
+            if not contiguous or group_work + work > self.target_work or \
+                    size > self.max_size:
+                for change in self._flush(group):
+                    yield change
+
+                group = []
+                group_work = 0.0
+
+            group.append(item_range)
+            group_work += work
+
+        for change in self._flush(group):
+            yield change
 
-    for num in xrange(start, end + 1, size):
-        print('{0}:{1}'.format(num, num + size - 1))
+    def _flush(self, group):
+        if len(group) > 1:
+            yield 'merge', group, [(group[0][0], group[-1][1])]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,75 @@
+'''Check that the pipeline and riddler start within a time budget.
+
+Starts each a few times in a fresh interpreter and prints the wall times
+as JSON. The first run may fill the discovery cache (see discovery.py),
+so the budget applies to the fastest run. Exits with status 1 if that is
+over the budget.
+
+Example::
+
+    python util/startup_time.py --budget 1.5
+
+Needs seesaw and a wget-lua like a real run does.
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOAD_PIPELINE = '''
+context = {'downloader': 'startup-check', '__name__': 'pipeline'}
+execfile('pipeline.py', context)
+'''
+
+COMMANDS = {
+    'pipeline': [sys.executable, '-c', LOAD_PIPELINE],
+    'riddler': [sys.executable, 'riddler.py', '--help'],
+}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--budget', type=float, default=1.5,
+        help='seconds allowed for each start')
+    arg_parser.add_argument('--runs', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    report = {'budget': args.budget}
+    over_budget = []
+
+    for name, command in sorted(COMMANDS.items()):
+        seconds = [time_command(command) for dummy in range(args.runs)]
+        report[name] = {'seconds': seconds, 'fastest': min(seconds)}
+
+        if min(seconds) > args.budget:
+            over_budget.append(name)
+
+    report['over_budget'] = over_budget
+
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+    if over_budget:
+        sys.exit(1)
+
+
+def time_command(command):
+    start_time = time.time()
+
+    with open(os.devnull, 'w') as null_file:
+        exit_code = subprocess.call(command, cwd=REPO_DIR, stdout=null_file)
+
+    if exit_code:
+        raise Exception('{0} exited with {1}.'.format(command, exit_code))
+
+    return time.time() - start_time
+
+
+if __name__ == '__main__':
+    main()
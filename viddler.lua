@@ -1,5 +1,114 @@
 local url_count = 0
 
+-- Named pipes to the pipeline's resolver pool (see resolver.py)
+local resolver_in_path = os.getenv("resolver_in")
+local resolver_out_path = os.getenv("resolver_out")
+local resolver_in = nil
+local resolver_out = nil
+
+-- Timing events for the pipeline (see metrics.py)
+local item_dir = os.getenv("item_dir")
+local events_file = nil
+
+if item_dir then
+  events_file = io.open(item_dir .. "/timings.jsonl", "a")
+end
+
+-- Finished video IDs, so a retried item can skip them (see checkpoint.py)
+local warc_segment = os.getenv("warc_segment")
+local checkpoint_file = nil
+local current_video_id = nil
+
+if item_dir and warc_segment and warc_segment ~= "" then
+  checkpoint_file = io.open(item_dir .. "/checkpoint.log", "a")
+end
+
+local uptime = function()
+  -- /proc/uptime has centisecond resolution and needs no fork
+  local file = io.open("/proc/uptime", "r")
+
+  if file then
+    local seconds = file:read("*n")
+    file:close()
+
+    if seconds then
+      return seconds
+    end
+  end
+
+  return os.time()
+end
+
+local json_string = function(s)
+  return '"' .. string.gsub(s, '[%c"\\]', function(c)
+    return string.format("\\u%04x", string.byte(c))
+  end) .. '"'
+end
+
+-- The time between two results is taken as the time of the second fetch
+local last_result_time = uptime()
+
+-- Send a line to the pipeline and read its answer up to an empty line
+local resolver_call = function(line)
+  local answer = {}
+
+  if not resolver_in then
+    resolver_in = assert(io.open(resolver_in_path, "w"))
+    resolver_out = assert(io.open(resolver_out_path, "r"))
+  end
+
+  resolver_in:write(line .. "\n")
+  resolver_in:flush()
+
+  for answer_line in resolver_out:lines() do
+    if answer_line == "" then
+      break
+    end
+
+    table.insert(answer, answer_line)
+  end
+
+  return answer
+end
+
+-- Running outside the pipeline; fall back to running riddler
+local resolve_video = function(video_id)
+  local video_urls = {}
+  local file = assert(io.popen('./riddler.py --wget '.. video_id, 'r'))
+  local output = file:read('*all')
+  file:close()
+
+  for video_url in output:gmatch("%S+") do
+    table.insert(video_urls, video_url)
+  end
+
+  return video_urls
+end
+
+-- Without the pipeline, wget downloads the videos itself. Their tokens
+-- only last a few minutes, so a 403 gets the video resolved again and
+-- the new URLs are queued with the next get_urls call.
+local max_video_resolves = 3
+local video_ids_by_url = {}
+local video_resolves = {}
+local requeued_urls = {}
+
+local queue_video_urls = function(urls, video_id)
+  for _, video_url in ipairs(resolve_video(video_id)) do
+    io.stdout:write(" Got video URL '"..video_url.."'\n")
+    io.stdout:flush()
+
+    video_ids_by_url[video_url] = video_id
+    table.insert(urls, {
+      url=video_url
+    })
+
+    video_found = true
+  end
+
+  video_resolves[video_id] = (video_resolves[video_id] or 0) + 1
+end
+
 wget.callbacks.httploop_result = function(url, err, http_stat)
   -- NEW for 2014: Slightly more verbose messages because people keep
   -- complaining that it's not moving or not working
@@ -7,30 +116,64 @@ wget.callbacks.httploop_result = function(url, err, http_stat)
   io.stdout:write(url_count .. "=" .. url["url"] .. ".  \r")
   io.stdout:flush()
 
-  -- We're okay; sleep a bit (if we have to) and continue
-  local sleep_time = 0.1 * (math.random(75, 125) / 100.0)
+  local status = http_stat["statcode"] or 0
+  local seconds = uptime() - last_result_time
 
-  if string.match(url["url"], "com/v/")
-  then
-    -- There's no time to sleep during brute force
-    sleep_time = 0
+  -- wget fetches all requisites of an input URL before it moves on to the
+  -- next, so a new video page means the previous video ID is finished.
+  -- The last ID of a run is never marked and is fetched again on retry.
+  local video_id = string.match(url["url"], "viddler%.com/v/([0-9a-f]+)$")
+
+  if video_id and video_id ~= current_video_id then
+    if checkpoint_file and current_video_id then
+      checkpoint_file:write("done " .. warc_segment .. " " .. current_video_id
+        .. "\n")
+      checkpoint_file:flush()
+    end
+
+    current_video_id = video_id
   end
 
-  if string.match(url["host"], "cdn")
-  then
-    -- We should be able to go fast on images since that's what a web browser does
-    sleep_time = 0
+  if events_file then
+    events_file:write('{"event": "url", "url": ' .. json_string(url["url"])
+      .. ', "status": ' .. tostring(status)
+      .. ', "bytes": ' .. tostring(http_stat["len"] or 0)
+      .. ', "seconds": ' .. string.format("%.2f", seconds)
+      .. '}\n')
+    events_file:flush()
   end
 
-  if sleep_time > 0.001 then
-    os.execute("sleep " .. sleep_time)
+  -- There's no time to sleep during brute force, and we should be able to
+  -- go fast on images since that's what a web browser does
+  local may_wait = not string.match(url["url"], "com/v/")
+    and not string.match(url["host"], "cdn")
+
+  if may_wait and resolver_in_path and resolver_out_path then
+    -- The pipeline paces requests per host and answers once we may go on
+    resolver_call("pace " .. url["host"] .. " " .. status .. " "
+      .. string.format("%.2f", seconds) .. " "
+      .. tostring(http_stat["len"] or 0))
+  elseif may_wait then
+    -- Without the pipeline, sleep a bit as we always did
+    os.execute("sleep " .. 0.1 * (math.random(75, 125) / 100.0))
   end
 
+  last_result_time = uptime()
+
   if (string.match(url["path"], "%.flv") or string.match(url["path"], "%.mp4"))
-  and http_stat["statcode"] == 403 then
-    io.stdout:write("Error: Got 403 on a video download.")
+  and status == 403 then
+    local video_id = video_ids_by_url[url["url"]]
+
+    if not video_id or video_resolves[video_id] >= max_video_resolves then
+      io.stdout:write("Error: Got 403 on a video download.")
+      io.stdout:flush()
+      return wget.actions.ABORT
+    end
+
+    io.stdout:write("\nGot 403, the token of video " .. video_id
+      .. " ran out. Resolving it again.\n")
     io.stdout:flush()
-    return wget.actions.ABORT
+    queue_video_urls(requeued_urls, video_id)
   end
 
   return wget.actions.NOTHING
@@ -38,7 +181,8 @@ end
 
 
 wget.callbacks.get_urls = function(file, url, is_css, iri)
-  local urls = {}
+  local urls = requeued_urls
+  requeued_urls = {}
 
   if string.match(url, "com/embed/[a-fA-F0-9]+") then
     local video_id = string.match(url, "com/embed/([a-fA-F0-9]+)")
@@ -49,25 +193,19 @@ wget.callbacks.get_urls = function(file, url, is_css, iri)
       url=video_url
     })
 
-    local command = './riddler.py --wget '.. video_id
     io.stdout:write("\n")
     io.stdout:flush()
 
-    local file = assert(io.popen(command, 'r'))
-    local video_urls = file:read('*all')
-    file:close()
-
-    for video_url in video_urls:gmatch("%S+") do
-      io.stdout:write(" Got video URL '"..video_url.."'\n")
+    if resolver_in_path and resolver_out_path then
+      -- The pipeline resolves and downloads the video on its own
+      -- connections while wget goes on (see resolver.py and videos.py)
+      resolver_call("queue " .. video_id)
+      io.stdout:write(" Queued video " .. video_id .. "\n")
       io.stdout:flush()
-
-      table.insert(urls, {
-        url=video_url
-      })
-
-      video_found = true
+    else
+      queue_video_urls(urls, video_id)
     end
   end
 
   return urls
-end
\ No newline at end of file
+end
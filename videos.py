@@ -0,0 +1,529 @@
+'''Downloads the video files of an item.
+
+The resolver lists the video URLs it finds in ``videos.jsonl`` of the
+item and hands them to the item's fetcher, which starts on them right
+away on its own connections while wget-lua goes on probing IDs. Large
+files are split into byte ranges that are fetched in parallel. The
+FetchVideos task of the pipeline waits for the rest and picks up the
+listed videos of a resumed item. The ranges of a file must add up to
+the length the server gives, or the file is fetched again. Videos the
+CDN answers with a lasting 4xx status are logged and skipped, as wget
+let them pass before; videos that still fail after `tries` attempts for
+any other reason fail the item.
+
+Once all ranges of a video are there, they go into the ``videos``
+segment of the item as one 200 response record for the URL without its
+token, followed by a metadata record that lists the range requests. The
+EdgeCast token in the URL is renewed as the download goes on, and after
+a 403.
+'''
+from __future__ import print_function
+
+import httplib
+import os
+import Queue
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urlparse
+
+import checkpoint
+import metrics
+import riddler
+import warcwriter
+
+
+LIST_NAME = 'videos.jsonl'
+DONE_NAME = 'videos.done'
+SEGMENT = 'videos'
+RANGE_SIZE = 16 * 1024 * 1024
+POLL_INTERVAL = 5
+TRANSIENT_STATUSES = (403, 408, 429)
+
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+
+class FetchError(Exception):
+    pass
+
+
+class VideoGone(FetchError):
+    '''The CDN has answered that the video is not there (any 4xx status
+    that retrying will not change).'''
+
+
+class Video(object):
+    def __init__(self, video_id, url):
+        self.video_id = video_id
+        self.url = url
+        self.path, separator, token = url.rpartition('?')
+        self.host = urlparse.urlsplit(url).hostname
+        self.length = None
+        self.parts = {}
+        self.missing = set()
+        self.error = None
+        self.lock = threading.Lock()
+
+    def current_url(self, tokens):
+        # The token in the resolved URL may have run out by now
+        return self.path + '?' + tokens.get(self.host)[0]
+
+
+class Part(object):
+    '''One request of a video, kept in a temporary file until the whole
+    video is there.'''
+    def __init__(self, start, end=None):
+        self.start = start
+        self.end = end
+        self.tries = 0
+        self.url = None
+        self.status = None
+        self.response_filename = None
+        self.header_length = None
+        self.body_length = 0
+        self.date = None
+        self.ip_address = None
+
+
+class VideoFetcher(object):
+    def __init__(self, connections=4, range_size=RANGE_SIZE, tries=5,
+            timeout=60, tokens=None, byte_rate=None):
+        self.connections = connections
+        self.range_size = range_size
+        self.tries = tries
+        self.timeout = timeout
+        self.tokens = tokens or riddler.EDGECAST_TOKENS
+        self.byte_rate = byte_rate
+
+    def fetch(self, item_dir, log=None):
+        '''Fetch the listed videos that are not done yet and return how
+        many were fetched.'''
+        self.start(item_dir, log)
+        self.add_listed()
+
+        return self.join()
+
+    def start(self, item_dir, log=None):
+        '''Start the connections, which then fetch each video as soon as
+        it is added.'''
+        self.item_dir = item_dir
+        self.log = log or (lambda message: None)
+        self.temp_dir = tempfile.mkdtemp(prefix='videos-', dir=item_dir)
+        self.events_path = os.path.join(item_dir, 'timings.jsonl')
+        self._queue = Queue.Queue()
+        self._pending = 0
+        self._pending_lock = threading.Condition()
+        self._errors = []
+        self._stopped = threading.Event()
+        self._seen_urls = set(self.done_urls())
+        self._video_count = 0
+        self._gone_count = 0
+        self._threads = [threading.Thread(target=self._run)
+            for dummy in range(self.connections)]
+
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def add(self, video_id, urls):
+        '''Fetch the video URLs unless they are done or on their way.'''
+        for url in urls:
+            video = Video(video_id, url)
+
+            with self._pending_lock:
+                if video.path in self._seen_urls:
+                    continue
+
+                self._seen_urls.add(video.path)
+                self._video_count += 1
+
+            self._schedule(video, Part(0, self.range_size - 1))
+
+    def add_listed(self):
+        '''Add the videos the resolver listed for the item.'''
+        list_path = os.path.join(self.item_dir, LIST_NAME)
+
+        if os.path.exists(list_path):
+            for entry in metrics.read_events(list_path):
+                self.add(entry['video_id'], entry['urls'])
+
+    def hold(self):
+        '''Keep join() waiting until release(), for a video that is still
+        being resolved.'''
+        with self._pending_lock:
+            self._pending += 1
+
+    def release(self):
+        self._task_done()
+
+    def join(self):
+        '''Wait for all videos and return how many were fetched. Videos
+        that are gone are left out; other failures raise FetchError.'''
+        with self._pending_lock:
+            while self._pending:
+                self._pending_lock.wait(1)
+
+        for thread in self._threads:
+            self._queue.put(None)
+
+        for thread in self._threads:
+            thread.join()
+
+        shutil.rmtree(self.temp_dir)
+
+        if self._errors:
+            raise FetchError('{0} videos failed: {1}'.format(
+                len(self._errors), '; '.join(self._errors)))
+
+        return self._video_count - self._gone_count
+
+    def stop(self):
+        '''Give up on the videos of an item that has ended without
+        join().'''
+        self._stopped.set()
+
+        for thread in self._threads:
+            self._queue.put(None)
+
+    def done_urls(self):
+        done_path = os.path.join(self.item_dir, DONE_NAME)
+
+        if os.path.exists(done_path):
+            with open(done_path) as in_file:
+                for line in in_file:
+                    yield line.strip()
+
+    def _schedule(self, video, part):
+        with self._pending_lock:
+            self._pending += 1
+
+        with video.lock:
+            video.missing.add(part.start)
+
+        self._queue.put((video, part))
+
+    def _task_done(self):
+        with self._pending_lock:
+            self._pending -= 1
+            self._pending_lock.notify_all()
+
+    def _run(self):
+        connections = {}
+
+        try:
+            while not self._stopped.is_set():
+                try:
+                    job = self._queue.get(timeout=POLL_INTERVAL)
+                except Queue.Empty:
+                    # Removing the item directory also ends the fetcher
+                    if os.path.exists(self.item_dir):
+                        continue
+                    break
+
+                if job is None or self._stopped.is_set():
+                    break
+
+                video, part = job
+
+                try:
+                    self._fetch_part(connections, video, part)
+                except Exception as error:
+                    self._part_failed(connections, video, part, error)
+                else:
+                    self._part_done(video, part)
+                finally:
+                    self._task_done()
+        finally:
+            for connection in connections.values():
+                connection.close()
+
+    def _part_failed(self, connections, video, part, error):
+        connection = connections.pop(video.host, None)
+
+        if connection:
+            connection.close()
+
+        if isinstance(error, VideoGone):
+            with video.lock:
+                first_error = not video.error
+                video.error = error
+
+            if first_error:
+                with self._pending_lock:
+                    self._gone_count += 1
+
+                self.log('Skipping {0}: {1}\n'.format(video.path, error))
+
+            return
+
+        part.tries += 1
+
+        if part.tries < self.tries and not video.error:
+            self.log('Retrying {0} from byte {1}: {2}\n'.format(video.path,
+                part.start, error))
+            self._schedule_retry(video, part)
+        elif not video.error:
+            video.error = error
+            self._errors.append('{0}: {1}'.format(video.path, error))
+
+    def _schedule_retry(self, video, part):
+        if part.response_filename and os.path.exists(part.response_filename):
+            os.remove(part.response_filename)
+
+        with self._pending_lock:
+            self._pending += 1
+
+        self._queue.put((video, part))
+
+    def _fetch_part(self, connections, video, part):
+        if video.error:
+            return
+
+        start_time = time.time()
+        part.url = video.current_url(self.tokens)
+        url_info = urlparse.urlsplit(part.url)
+        connection = connections.get(video.host)
+
+        if not connection:
+            connection = connections[video.host] = httplib.HTTPConnection(
+                url_info.netloc, timeout=self.timeout)
+
+        headers = [
+            ('Host', url_info.netloc),
+            ('User-Agent', riddler.USER_AGENT),
+            ('Accept', '*/*'),
+        ]
+
+        if part.end is None:
+            headers.append(('Range', 'bytes={0}-'.format(part.start)))
+        else:
+            headers.append(('Range', 'bytes={0}-{1}'.format(part.start,
+                part.end)))
+
+        path = url_info.path + ('?' + url_info.query if url_info.query else '')
+
+        connection.putrequest('GET', path, skip_host=True,
+            skip_accept_encoding=True)
+
+        for name, value in headers:
+            connection.putheader(name, value)
+
+        connection.endheaders()
+
+        response = connection.getresponse()
+        part.date = warcwriter.warc_date()
+        part.status = response.status
+
+        try:
+            part.ip_address = connection.sock.getpeername()[0]
+        except (AttributeError, socket.error):
+            part.ip_address = None
+
+        self._save_response(video, part, response)
+
+        metrics.append_event(self.events_path, {
+            'event': 'url',
+            'url': video.url,
+            'status': response.status,
+            'bytes': part.body_length,
+            'seconds': time.time() - start_time,
+        })
+
+        if response.will_close:
+            connections.pop(video.host).close()
+
+        if response.status == 403:
+            # Most likely the token ran out before the request got there
+            self.tokens.refresh(video.host)
+            raise FetchError('Got 403, renewed the token.')
+
+        self._check_part(video, part, response)
+
+    def _save_response(self, video, part, response):
+        '''Stream the response into a temporary file.'''
+        handle, part.response_filename = tempfile.mkstemp(dir=self.temp_dir)
+        head = http_response_head(response)
+        part.header_length = len(head)
+        part.body_length = 0
+
+        with os.fdopen(handle, 'wb') as out_file:
+            out_file.write(head)
+
+            while True:
+                data = response.read(65536)
+
+                if not data:
+                    break
+
+                out_file.write(data)
+                part.body_length += len(data)
+
+                if self.byte_rate:
+                    # Keep within the bandwidth budget (see pacing.py)
+                    time.sleep(self.byte_rate.consume(len(data)))
+
+    def _check_part(self, video, part, response):
+        if response.status == 200:
+            # No ranges; this is the whole file
+            content_length = response.getheader('content-length')
+
+            if content_length and int(content_length) != part.body_length:
+                raise FetchError('Got {0} of {1} bytes.'.format(
+                    part.body_length, content_length))
+
+            if part.start != 0:
+                raise FetchError('Server ignored the range.')
+
+            with video.lock:
+                video.length = part.body_length
+
+            return
+
+        if 400 <= response.status < 500 and \
+                response.status not in TRANSIENT_STATUSES:
+            raise VideoGone('Got status {0}.'.format(response.status))
+
+        if response.status != 206:
+            raise FetchError('Got status {0}.'.format(response.status))
+
+        match = CONTENT_RANGE_PATTERN.match(
+            response.getheader('content-range', ''))
+
+        if not match:
+            raise FetchError('Bad Content-Range {0!r}.'.format(
+                response.getheader('content-range')))
+
+        start, end, length = (int(value) for value in match.groups())
+
+        if start != part.start or end - start + 1 != part.body_length:
+            raise FetchError('Got bytes {0}-{1} ({2} bytes) for {3}.'.format(
+                start, end, part.body_length, part.start))
+
+        part.end = end
+
+        with video.lock:
+            first_answer = video.length is None
+            video.length = length
+
+        if first_answer and part.start == 0:
+            # Fetch the rest of a large file in parallel
+            for range_start in xrange(end + 1, length, self.range_size):
+                self._schedule(video, Part(range_start,
+                    min(range_start + self.range_size, length) - 1))
+
+    def _part_done(self, video, part):
+        with video.lock:
+            video.parts[part.start] = part
+            video.missing.discard(part.start)
+            complete = not video.missing and not video.error
+
+        if complete:
+            try:
+                self._finish_video(video)
+            except Exception as error:
+                video.error = error
+                self._errors.append('{0}: {1}'.format(video.path, error))
+
+    def _finish_video(self, video):
+        parts = [video.parts[start] for start in sorted(video.parts)]
+        received = sum(part.body_length for part in parts)
+
+        if received != video.length:
+            raise FetchError('Got {0} of {1} bytes.'.format(received,
+                video.length))
+
+        metadata = warcwriter.warc_fields([
+            ('viddler-video-id', video.video_id),
+            ('viddler-video-url', video.path),
+            ('viddler-video-length', video.length),
+        ] + [
+            ('viddler-video-range', '{0}-{1} {2} {3} {4}'.format(part.start,
+                part.start + part.body_length - 1, part.status, part.date,
+                part.url))
+            for part in parts
+        ])
+
+        response_filename, header_length = self._join_parts(video, parts)
+        ip_headers = []
+
+        if parts[0].ip_address:
+            ip_headers.append(('WARC-IP-Address', parts[0].ip_address))
+
+        item_checkpoint = checkpoint.Checkpoint(self.item_dir)
+
+        with item_checkpoint.appending(SEGMENT) as out_file:
+            writer = warcwriter.WarcWriter(out_file)
+            response_id = writer.write_file_record('response',
+                response_filename, warcwriter.HTTP_RESPONSE_TYPE,
+                header_length, video.path, parts[0].date, headers=ip_headers)
+            writer.write_record('metadata', metadata,
+                warcwriter.WARC_FIELDS_TYPE, video.path,
+                headers=[('WARC-Concurrent-To', response_id)])
+
+        with open(os.path.join(self.item_dir, DONE_NAME), 'a') as out_file:
+            out_file.write(video.path + '\n')
+
+        os.remove(response_filename)
+
+        self.log('Fetched {0} ({1} bytes in {2} ranges).\n'.format(
+            video.path, video.length, len(parts)))
+
+
+    def _join_parts(self, video, parts):
+        '''Put the ranges of a video together as one 200 response and
+        return its file name and header length.
+
+        Each range is removed once it is copied, so a video takes little
+        more than its own size in the temporary directory.
+        '''
+        head = whole_response_head(parts[0].response_filename,
+            parts[0].header_length, video.length)
+        handle, filename = tempfile.mkstemp(dir=self.temp_dir)
+
+        with os.fdopen(handle, 'wb') as out_file:
+            out_file.write(head)
+
+            for part in parts:
+                with open(part.response_filename, 'rb') as in_file:
+                    in_file.seek(part.header_length)
+                    shutil.copyfileobj(in_file, out_file)
+
+                os.remove(part.response_filename)
+
+        return filename, len(head)
+
+
+def whole_response_head(filename, header_length, length):
+    '''Turn the head of a range response into that of a 200 response
+    with the whole file.'''
+    with open(filename, 'rb') as in_file:
+        head = in_file.read(header_length)
+
+    header_lines = [line + '\r\n' for line in head.split('\r\n')[1:]
+        if line and line.split(':', 1)[0].strip().lower() not in
+            ('content-length', 'content-range', 'transfer-encoding')]
+
+    return 'HTTP/1.1 200 OK\r\n{0}Content-Length: {1}\r\n\r\n'.format(
+        ''.join(header_lines), length)
+
+
+def http_response_head(response):
+    '''Put the status line and headers of an httplib response back
+    together.'''
+    version = 'HTTP/1.0' if response.version == 10 else 'HTTP/1.1'
+    header_lines = [line.rstrip('\r\n') + '\r\n'
+        for line in response.msg.headers]
+
+    return '{0} {1} {2}\r\n{3}\r\n'.format(version, response.status,
+        response.reason, ''.join(header_lines))
+
+
+def add_video(item_dir, video_id, urls):
+    '''List the resolved video URLs for FetchVideos.'''
+    metrics.append_event(os.path.join(item_dir, LIST_NAME), {
+        'video_id': video_id,
+        'urls': urls,
+    })
@@ -0,0 +1,207 @@
+'''A small WARC/1.0 writer.
+
+Every record is written as its own gzip member, so the output can be
+appended to and concatenated like the WARCs wget writes. The record is
+compressed as it is written instead of being built in memory first.
+'''
+from __future__ import print_function
+
+import base64
+import hashlib
+import os
+import time
+import uuid
+import zlib
+
+
+WARC_VERSION = 'WARC/1.0'
+HTTP_REQUEST_TYPE = 'application/http;msgtype=request'
+HTTP_RESPONSE_TYPE = 'application/http;msgtype=response'
+WARC_FIELDS_TYPE = 'application/warc-fields'
+
+
+def new_record_id():
+    return '<urn:uuid:{0}>'.format(uuid.uuid4())
+
+
+def warc_date(timestamp=None):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+def sha1_digest(data):
+    return 'sha1:' + base64.b32encode(hashlib.sha1(data).digest())
+
+
+def http_payload(block):
+    '''Return the entity body of an HTTP message.'''
+    head, separator, body = block.partition(b'\r\n\r\n')
+
+    return body
+
+
+def warc_fields(fields):
+    return b''.join('{0}: {1}\r\n'.format(name, value)
+        for name, value in fields)
+
+
+def record_spans(in_file):
+    '''Yield the offset and length of each record of an uncompressed WARC.
+
+    A record torn off at the end of the file is left out.
+    '''
+    file_size = os.fstat(in_file.fileno()).st_size
+    offset = 0
+
+    while offset < file_size:
+        in_file.seek(offset)
+        line = in_file.readline()
+
+        if not line.endswith(b'\n'):
+            return
+
+        if not line.startswith(b'WARC/'):
+            raise ValueError('No WARC record at offset {0}.'.format(offset))
+
+        content_length = None
+
+        while True:
+            line = in_file.readline()
+
+            if not line.endswith(b'\n'):
+                return
+
+            if not line.strip():
+                break
+
+            name, separator, value = line.partition(b':')
+
+            if name.strip().lower() == b'content-length':
+                content_length = int(value)
+
+        if content_length is None:
+            raise ValueError('No Content-Length in the record at offset '
+                '{0}.'.format(offset))
+
+        # The block is followed by two CRLFs
+        end = in_file.tell() + content_length + 4
+
+        if end > file_size:
+            return
+
+        yield offset, end - offset
+        offset = end
+
+
+def warc_complete_length(filename):
+    '''Return the length of an uncompressed WARC up to the end of its last
+    whole record.'''
+    length = 0
+
+    with open(filename, 'rb') as in_file:
+        for offset, record_length in record_spans(in_file):
+            length = offset + record_length
+
+    return length
+
+
+class WarcWriter(object):
+    def __init__(self, out_file, compress_level=6, chunk_size=65536):
+        self.out_file = out_file
+        self.compress_level = compress_level
+        self.chunk_size = chunk_size
+
+    def write_record(self, record_type, block, content_type, target_uri=None,
+            date=None, record_id=None, headers=()):
+        '''Write one record and return its record ID.
+
+        `headers` holds any more (name, value) pairs for the WARC header.
+        '''
+        payload_digest = None
+
+        if content_type in (HTTP_REQUEST_TYPE, HTTP_RESPONSE_TYPE):
+            payload_digest = sha1_digest(http_payload(block))
+
+        chunks = (block[offset:offset + self.chunk_size]
+            for offset in xrange(0, len(block), self.chunk_size))
+
+        return self._write(record_type, content_type, len(block),
+            sha1_digest(block), payload_digest, chunks, target_uri, date,
+            record_id, headers)
+
+    def write_file_record(self, record_type, filename, content_type,
+            payload_offset=None, target_uri=None, date=None, record_id=None,
+            headers=()):
+        '''Write one record with the content of a file as its block.
+
+        The payload starts `payload_offset` bytes into the file. The file
+        is read twice, for the digests and for the record, and is never
+        held in memory whole.
+        '''
+        block_hash = hashlib.sha1()
+        payload_hash = hashlib.sha1()
+        length = 0
+
+        for chunk in self._read_chunks(filename):
+            block_hash.update(chunk)
+
+            if payload_offset is not None and \
+                    length + len(chunk) > payload_offset:
+                payload_hash.update(chunk[max(0, payload_offset - length):])
+
+            length += len(chunk)
+
+        block_digest = 'sha1:' + base64.b32encode(block_hash.digest())
+        payload_digest = None
+
+        if payload_offset is not None:
+            payload_digest = 'sha1:' + base64.b32encode(payload_hash.digest())
+
+        return self._write(record_type, content_type, length, block_digest,
+            payload_digest, self._read_chunks(filename), target_uri, date,
+            record_id, headers)
+
+    def _read_chunks(self, filename):
+        with open(filename, 'rb') as in_file:
+            while True:
+                chunk = in_file.read(self.chunk_size)
+
+                if not chunk:
+                    break
+
+                yield chunk
+
+    def _write(self, record_type, content_type, length, block_digest,
+            payload_digest, chunks, target_uri, date, record_id, headers):
+        record_id = record_id or new_record_id()
+        warc_headers = [
+            ('WARC-Type', record_type),
+            ('WARC-Record-ID', record_id),
+            ('WARC-Date', date or warc_date()),
+        ]
+
+        if target_uri:
+            warc_headers.append(('WARC-Target-URI', target_uri))
+
+        warc_headers.extend(headers)
+        warc_headers.append(('Content-Type', content_type))
+        warc_headers.append(('WARC-Block-Digest', block_digest))
+
+        if payload_digest:
+            warc_headers.append(('WARC-Payload-Digest', payload_digest))
+
+        warc_headers.append(('Content-Length', length))
+
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+            16 + zlib.MAX_WBITS)
+        write = self.out_file.write
+
+        write(compressor.compress(WARC_VERSION + '\r\n' +
+            warc_fields(warc_headers) + '\r\n'))
+
+        for chunk in chunks:
+            write(compressor.compress(chunk))
+
+        write(compressor.compress(b'\r\n\r\n'))
+        write(compressor.flush())
+
+        return record_id
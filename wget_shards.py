@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+'''Run several wget-lua processes for one item side by side.
+
+The pipeline writes a JSON file describing the shards of an item and runs
+this script in place of wget::
+
+    {
+        "accept_on_exit_code": [0, 8],
+        "shards": [{"args": [...], "env": {...}}, ...]
+    }
+
+The exit code is the first unaccepted one returned by a shard, otherwise
+the highest accepted one. An empty list of shards, which happens when no
+ID of the item is live, exits with 0.
+'''
+from __future__ import print_function
+
+import json
+import os
+import signal
+import subprocess
+import sys
+
+
+def main():
+    with open(sys.argv[1]) as in_file:
+        doc = json.load(in_file)
+
+    processes = []
+
+    def terminate(signum, frame):
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    for shard in doc['shards']:
+        env = dict(os.environ)
+        env.update(shard['env'])
+        processes.append(subprocess.Popen(shard['args'], env=env))
+
+    exit_codes = [process.wait() for process in processes]
+
+    sys.exit(combine_exit_codes(exit_codes, doc['accept_on_exit_code']))
+
+
+def combine_exit_codes(exit_codes, accept_on_exit_code):
+    for exit_code in exit_codes:
+        if exit_code not in accept_on_exit_code:
+            return exit_code
+
+    return max(exit_codes or [0])
+
+
+if __name__ == '__main__':
+    main()